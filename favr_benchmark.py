@@ -0,0 +1,424 @@
+#!/bin/env python
+
+'''
+Benchmarks for the FAVR programs.
+
+Times parts of the FAVR programs on synthetic inputs, so that changes to
+the code can be compared with each other.
+
+Revision history:
+
+17 Oct 2026.   Initial version. Benchmarks the per-BAM cost of parsing the
+               variant rows.
+               Added --benchmark=readSize, which compares the per-site cost
+               of the ways favr_pe_bias_detector.py finds read sizes on a
+               dense-coverage synthetic BAM file.
+               Added --benchmark=suite, which times the main stages of the
+               FAVR programs on synthetic inputs made by favr_synthetic.py,
+               and saves the results as JSON with --output.
+               Added --benchmark=prefetch, which compares counting with and
+               without reading ahead on simulated slow storage.
+               The readSize and suite benchmarks also time the column
+               engine, when pysam has it.
+               The suite checks that the evidence engines give the same
+               tally of every variant site in every bam file, not only the
+               same counts in the comparators.
+'''
+
+import os
+import sys
+import csv
+import time
+import getopt
+import random
+import shutil
+import tempfile
+import json
+import resource
+import pysam
+from favr_common import (safeReadInt, parseVariantRow, VariantTable, getEvidence, EvidenceOptions,
+                         evidenceEngines, lookupPileup, tallyPileupColumn, PileupFilters,
+                         columnEngineAvailable)
+from favr_prefetch import (Prefetcher, SimulatedStorage, readRanges, defaultPrefetchDepth)
+from favr_pe_bias_detector import (count_read_sizes, readSizes)
+import favr_synthetic
+import favr_rare_and_true_filter
+import favr_family_annotate
+import favr_refgene_annotate
+
+# print a usage message
+def usage():
+    print("""Usage: %s
+    [-h | --help]
+    [--benchmark=<parse | readSize | suite | prefetch>]
+    [--variants=<number of synthetic variants>]
+    [--bams=<number of BAM file passes to simulate, or BAM files to make>]
+    [--sites=<number of variant sites in the synthetic BAM file>]
+    [--depth=<number of reads covering each site>]
+    [--pairs=<number of read pairs in each synthetic BAM file>]
+    [--chromosomes=<number of chromosomes in the synthetic reference>]
+    [--chromosomeLength=<length of each chromosome>]
+    [--genes=<number of genes in the synthetic refGene table>]
+    [--inputs=<directory to keep the synthetic inputs in>]
+    [--output=<JSON results file>]
+    [--latency=<milliseconds to read each uncached block>]
+    [--prefetch=<number of variants to read ahead>]
+    [--seed=<random seed>]""" % sys.argv[0])
+
+longOptionsFlags = ["help", "benchmark=", "variants=", "bams=", "sites=", "depth=", "pairs=", "chromosomes=",
+                    "chromosomeLength=", "genes=", "inputs=", "output=", "latency=", "prefetch=", "seed="]
+shortOptionsFlags = "h"
+
+# A place to store command line arguments.
+class Options(object):
+    def __init__(self):
+        self.benchmark = 'parse'
+        self.variants = 100000
+        self.bams = 10
+        self.sites = 200
+        self.depth = 1000
+        self.pairs = 100000
+        self.chromosomes = 4
+        self.chromosomeLength = 250000
+        self.genes = 1000
+        self.inputs = None
+        self.output = None
+        self.latency = 2
+        self.prefetch = defaultPrefetchDepth
+        self.seed = 1
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], shortOptionsFlags, longOptionsFlags)
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+    options = Options()
+    for o, a in opts:
+        if o == "--benchmark":
+            if a not in benchmarks:
+                raise Exception, 'unknown benchmark: ' + a
+            options.benchmark = a
+        elif o == "--variants":
+            options.variants = safeReadInt(a)
+        elif o == "--bams":
+            options.bams = safeReadInt(a)
+        elif o == "--sites":
+            options.sites = safeReadInt(a)
+        elif o == "--depth":
+            options.depth = safeReadInt(a)
+        elif o == "--pairs":
+            options.pairs = safeReadInt(a)
+        elif o == "--chromosomes":
+            options.chromosomes = safeReadInt(a)
+        elif o == "--chromosomeLength":
+            options.chromosomeLength = safeReadInt(a)
+        elif o == "--genes":
+            options.genes = safeReadInt(a)
+        elif o == "--inputs":
+            options.inputs = a
+        elif o == "--output":
+            options.output = a
+        elif o == "--latency":
+            options.latency = safeReadInt(a)
+        elif o == "--prefetch":
+            options.prefetch = safeReadInt(a)
+        elif o == "--seed":
+            options.seed = safeReadInt(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+    random.seed(options.seed)
+    benchmarks[options.benchmark](options)
+
+def syntheticVariants(count):
+    '''Make a list of SIFT style variant rows on random coordinates.'''
+    variantList = []
+    for n in xrange(count):
+        chr = random.choice(['1', '2', '10', 'X'])
+        position = random.randint(1, 10000000)
+        refBase, variantBase = random.sample('ACGT', 2)
+        variantList.append(['%s,%d,1,%s/%s' % (chr, position, refBase, variantBase), 'variant%d' % n])
+    return variantList
+
+def benchmarkParse(options):
+    '''Compare the per-BAM cost of parsing every variant row for each BAM file
+    with the cost of reading the variants from a VariantTable parsed once.'''
+    variantList = syntheticVariants(options.variants)
+    start = time.time()
+    for bam in xrange(options.bams):
+        for variant in variantList:
+            info = parseVariantRow(variant)
+            if info:
+                info.chromosome, info.position, info.variantBase
+    parsePerBam = (time.time() - start) / options.bams
+    start = time.time()
+    table = VariantTable(variantList)
+    tableBuild = time.time() - start
+    start = time.time()
+    for bam in xrange(options.bams):
+        for index in xrange(len(table)):
+            table.chromosome(index), table.positions[index], table.variantBases[index]
+    tablePerBam = (time.time() - start) / options.bams
+    print('variants: %d, bams: %d' % (options.variants, options.bams))
+    print('parse rows for every bam: %.3f seconds per bam' % parsePerBam)
+    print('variant table: %.3f seconds to build, then %.3f seconds per bam' % (tableBuild, tablePerBam))
+
+# the spacing of the sites in the synthetic BAM file, more than a read length
+# apart so each read covers at most one site
+syntheticSiteSpacing = 100
+
+def writeDenseBam(filename, sites, depth):
+    '''Write a sorted and indexed BAM file on one chromosome (chr1) with depth
+    reads covering each site, a mix of 35 and 50 base reads, some of them
+    with a deletion. Returns the (1-based) positions of the sites.'''
+    positions = [syntheticSiteSpacing * (n + 1) for n in xrange(sites)]
+    header = { 'HD': {'VN': '1.0', 'SO': 'coordinate'},
+               'SQ': [{'SN': 'chr1', 'LN': syntheticSiteSpacing * (sites + 2)}] }
+    with pysam.Samfile(filename, 'wb', header = header) as bam:
+        for position in positions:
+            reads = []
+            for n in xrange(depth):
+                length = random.choice([35, 50])
+                # start the read so that it covers the site
+                start = position - 1 - random.randint(0, length - 1)
+                read = pysam.AlignedRead()
+                read.qname = 'read%d_%d' % (position, n)
+                read.flag = 0
+                read.rname = 0
+                read.pos = start
+                read.mapq = 60
+                read.seq = ''.join(random.choice('ACGT') for base in xrange(length))
+                read.qual = 'I' * length
+                read.cigar = [(0, length)]
+                # one read in ten has a deletion after the site
+                offset = position - 1 - start
+                if random.random() < 0.1 and offset < length - 2:
+                    read.cigar = [(0, offset + 1), (2, 2), (0, length - offset - 1)]
+                reads.append(read)
+            for read in sorted(reads, key = lambda read: read.pos):
+                bam.write(read)
+    pysam.index(filename)
+    return positions
+
+def benchmarkReadSize(options):
+    '''Compare the per-site cost of each way of finding the read sizes of the
+    reads supporting a variant, on a synthetic BAM file with dense coverage.'''
+    directory = tempfile.mkdtemp()
+    try:
+        bamFilename = os.path.join(directory, 'dense.bam')
+        positions = writeDenseBam(bamFilename, options.sites, options.depth)
+        # a variant for each base at each site, so every read supports one
+        variants = [['1', str(position), '1', 'A/' + base] for position in positions for base in 'ACGT']
+        print('sites: %d, depth: %d' % (options.sites, options.depth))
+        with pysam.Samfile(bamFilename, 'rb') as bam:
+            # the reads covering each site, to time finding their sizes on its own
+            reads = [read for position in positions for read in bam.fetch('chr1', position - 1, position)]
+            for readSize in sorted(readSizes):
+                start = time.time()
+                for variant in variants:
+                    count_read_sizes(variant, bam, [], readSize)
+                perSite = (time.time() - start) / options.sites
+                start = time.time()
+                for read in reads:
+                    readSizes[readSize](read)
+                sizePerSite = (time.time() - start) / options.sites
+                print('readSize=%s: %.3f milliseconds per site, of which %.3f finding read sizes' %
+                      (readSize, perSite * 1000, sizePerSite * 1000))
+            if columnEngineAvailable():
+                # the bases of each column in one call, with the same read filters as the pileup
+                start = time.time()
+                for variant in variants:
+                    count_read_sizes(variant, bam, [], 'query', PileupFilters())
+                perSite = (time.time() - start) / options.sites
+                print('column engine, readSize=query: %.3f milliseconds per site' % (perSite * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+def peakMemory():
+    '''The peak resident set size so far, in kilobytes, of this process and
+    of its (waited for) child processes.'''
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+class SuiteResults(object):
+    '''The time taken by each stage of the suite, and how many items it handled.'''
+    def __init__(self, options):
+        self.parameters = dict((name, getattr(options, name)) for name in
+            ['variants', 'bams', 'pairs', 'chromosomes', 'chromosomeLength', 'genes', 'seed'])
+        self.stages = []
+        self.checks = {}
+    def time(self, name, items, function, *args):
+        '''Run a stage, recording its time and the peak memory after it, and
+        return its result.'''
+        start = time.time()
+        result = function(*args)
+        seconds = time.time() - start
+        selfRss, childrenRss = peakMemory()
+        self.stages.append({ 'stage': name, 'seconds': seconds, 'items': items,
+                             'itemsPerSecond': items / seconds if seconds > 0 else None,
+                             'peakRssKb': selfRss, 'peakChildRssKb': childrenRss })
+        print('%-24s %10.3f seconds %12.1f items/second %10d KB peak RSS' %
+              (name, seconds, items / seconds if seconds > 0 else 0, selfRss))
+        return result
+    def report(self):
+        return { 'python': sys.version.split()[0], 'pysam': pysam.__version__,
+                 'parameters': self.parameters, 'stages': self.stages, 'checks': self.checks }
+
+def makeSuiteInputs(options, directory):
+    '''Write the synthetic inputs of the suite into the directory.'''
+    inputs = {}
+    reference = favr_synthetic.syntheticReference(options.chromosomes, options.chromosomeLength)
+    inputs['reference'] = os.path.join(directory, 'reference.fa')
+    favr_synthetic.writeReference(inputs['reference'], reference)
+    variants = favr_synthetic.syntheticVariants(reference, options.variants)
+    inputs['variants'] = os.path.join(directory, 'variants.tsv')
+    favr_synthetic.writeVariantRows(inputs['variants'], variants)
+    inputs['peVariants'] = os.path.join(directory, 'variants.csv')
+    favr_synthetic.writeVariantRows(inputs['peVariants'], variants, delimiter=',')
+    inputs['bams'] = []
+    for n in xrange(options.bams):
+        bamFilename = os.path.join(directory, 'sample%d.bam' % n)
+        # the first sample carries the most variants, as the proband would
+        favr_synthetic.writeSyntheticBam(bamFilename, reference, options.pairs, variants,
+                                         0.9 if n == 0 else 0.05)
+        inputs['bams'].append(bamFilename)
+    inputs['refGene'] = os.path.join(directory, 'refGene.txt')
+    favr_synthetic.writeSyntheticRefGene(inputs['refGene'], reference, options.genes)
+    return inputs
+
+def readRows(filename, delimiter):
+    with open(filename) as file:
+        return list(csv.reader(file, delimiter=delimiter, quotechar='|'))
+
+def enginesAgree(table, bamFilenames):
+    '''Do all of the evidence engines give the same tally of each site of the
+    table in each BAM file? The tallies count every base, so they differ
+    even where the counts of the variant bases happen to be the same.'''
+    sites, siteIndices = table.sites()
+    for bamFilename in bamFilenames:
+        with pysam.Samfile(bamFilename, 'rb') as bam:
+            tallies = dict((engine, [list(tally) for tally in evidenceEngines[engine](sites, bam)])
+                           for engine in evidenceEngines
+                           if engine != 'column' or columnEngineAvailable())
+        if any(tallies[engine] != tallies['pileup'] for engine in tallies):
+            return False
+    return True
+
+def benchmarkSuite(options):
+    '''Time the main stages of the FAVR programs on synthetic inputs: counting
+    the evidence with each engine, finding read sizes, reading and searching
+    the refGene table, and classifying and writing the outputs. Checks that
+    all of the evidence engines give the same counts.'''
+    directory = options.inputs or tempfile.mkdtemp()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    try:
+        results = SuiteResults(options)
+        inputs = results.time('make inputs', options.bams * options.pairs * 2, makeSuiteInputs, options, directory)
+        variantList = readRows(inputs['variants'], '\t')
+        comparators = inputs['bams'][1:]
+        evidenceOptions = EvidenceOptions()
+        counts = {}
+        for engine in sorted(evidenceEngines):
+            if engine == 'column' and not columnEngineAvailable():
+                continue
+            evidenceOptions.engine = engine
+            evidence = results.time('getEvidence engine=%s' % engine, len(variantList) * len(comparators),
+                                    getEvidence, variantList, comparators, evidenceOptions)
+            counts[engine] = [(index, info.counts) for index,info in evidence.items()]
+        results.checks['enginesAgree'] = all(counts[engine] == counts['pileup'] for engine in counts) and \
+            enginesAgree(VariantTable(variantList), inputs['bams'])
+        peVariants = readRows(inputs['peVariants'], ',')
+        with pysam.Samfile(inputs['bams'][0], 'rb') as bam:
+            for readSize in sorted(readSizes):
+                results.time('count_read_sizes %s' % readSize, len(peVariants),
+                             lambda: [count_read_sizes(variant, bam, [], readSize) for variant in peVariants])
+            if columnEngineAvailable():
+                results.time('count_read_sizes column', len(peVariants),
+                             lambda: [count_read_sizes(variant, bam, [], 'query', PileupFilters())
+                                      for variant in peVariants])
+        refGeneOptions = favr_refgene_annotate.Options()
+        refGeneOptions.refGene = inputs['refGene']
+        refGeneOptions.startslack = 50
+        refGeneOptions.spliceslack = 10
+        refGene = results.time('readRefGene', options.genes, favr_refgene_annotate.readRefGene, refGeneOptions)
+        coordinates = [parseVariantRow(row) for row in variantList]
+        results.time('refGene search', len(coordinates),
+                     lambda: [favr_refgene_annotate.search(info.chromosome, info.position, refGene)
+                              for info in coordinates])
+        filterOptions = favr_rare_and_true_filter.Options()
+        filterOptions.varLikeThresh = 2
+        filterOptions.samplesPercent = 10
+        filterOptions.log = os.path.join(directory, 'filter.log')
+        filterOptions.bin = os.path.join(directory, 'filter.bin')
+        filterOptions.keep = os.path.join(directory, 'filter.keep')
+        results.time('classify and write', len(evidence), favr_rare_and_true_filter.filter, filterOptions, evidence)
+        familyOptions = favr_family_annotate.Options()
+        familyOptions.annotations = os.path.join(directory, 'family.tsv')
+        results.time('annotate family', len(evidence), favr_family_annotate.annotate, familyOptions, None, evidence)
+    finally:
+        if options.inputs == None:
+            shutil.rmtree(directory)
+    print('evidence engines agree: %s' % results.checks['enginesAgree'])
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results.report(), output, indent=2, sort_keys=True)
+
+# The size of the blocks of the simulated storage, the size of a page of
+# the page cache, so that reading the part of the bam file covering a
+# variant usually reads some blocks which were not read before.
+simulatedBlockSize = 4096
+
+def benchmarkPrefetch(options):
+    '''Compare counting variants with and without reading ahead, on storage
+    which takes --latency milliseconds to read each block which was not
+    read before. Pysam reads the bam file itself, so the counting reads
+    the part of the bam file covering each variant from the simulated
+    storage before counting it, as the samtools seek would.'''
+    directory = tempfile.mkdtemp()
+    try:
+        reference = favr_synthetic.syntheticReference(options.chromosomes, options.chromosomeLength)
+        variants = favr_synthetic.syntheticVariants(reference, options.variants)
+        bamFilename = os.path.join(directory, 'sample.bam')
+        favr_synthetic.writeSyntheticBam(bamFilename, reference, options.pairs, variants, 0.5)
+        table = VariantTable([favr_synthetic.variantRow(variant, n) for n,variant in enumerate(variants)])
+        regions = [(table.chromosome(index), table.positions[index] - 1, table.positions[index])
+                   for index in xrange(len(table))]
+        print('variants: %d, pairs: %d, latency: %d milliseconds per block' %
+              (options.variants, options.pairs, options.latency))
+        allCounts = []
+        for depth in [0, options.prefetch]:
+            storage = SimulatedStorage(options.latency / 1000.0, simulatedBlockSize)
+            counts = []
+            start = time.time()
+            with pysam.Samfile(bamFilename, 'rb') as bam:
+                prefetcher = Prefetcher(bamFilename, bam.references, regions, depth,
+                                        threads = 0 if depth == 0 else 2, opener = storage.open)
+                try:
+                    with storage.open(bamFilename) as bamFile:
+                        for index,region in enumerate(regions):
+                            readRanges(bamFile, prefetcher.byteRanges(region))
+                            pileupCol = lookupPileup(bam, region[0], region[2])
+                            counts.append(tallyPileupColumn(pileupCol))
+                            prefetcher.advance(index + 1)
+                finally:
+                    prefetcher.close()
+            seconds = time.time() - start
+            allCounts.append(counts)
+            print('prefetch=%d: %.3f seconds, %d uncached blocks, at most %d reads in flight' %
+                  (depth, seconds, storage.uncachedBlocks, storage.maxInFlight))
+        print('counts agree: %s' % (allCounts[0] == allCounts[1]))
+    finally:
+        shutil.rmtree(directory)
+
+benchmarks = {
+    'parse': benchmarkParse,
+    'readSize': benchmarkReadSize,
+    'suite': benchmarkSuite,
+    'prefetch': benchmarkPrefetch,
+}
+
+if __name__ == '__main__':
+    main()
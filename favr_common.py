@@ -7,6 +7,18 @@ Authors: Bernie Pope, Danny Park, Fabrice Odefrey, Tu Nguyen-Dumont.
 import os
 import pysam
 import sys
+import multiprocessing
+import bisect
+import heapq
+import time
+import json
+from contextlib import contextmanager
+from array import array
+from operator import itemgetter
+from itertools import izip
+from favr_evidence_cache import (EvidenceCache, defaultEvidenceCacheSize)
+from favr_panel_store import (Panel, tallySize, tallyDeletions, tallyCoverage, tallyBaseIndex)
+from favr_prefetch import (Prefetcher, prefetching, canPrefetch)
 
 def safeReadInt(str):
     if str.isdigit():
@@ -14,81 +26,932 @@ def safeReadInt(str):
     else:
         raise Exception, 'not an integer: ' + str
 
-# sort the variants by coordinate.
-def sortByCoord(evidence):
-    return sorted(evidence.items(), cmp=compareCoord)
+# The statistics of a run of a FAVR program, saved as a JSON report with
+# --stats: the wall time and number of calls of each stage of the program,
+# counters of the work done (such as pileup columns visited and reads
+# inspected), and the number of variants counted per second in each BAM file.
+class Stats(object):
+    def __init__(self, tool):
+        self.tool = tool
+        self.start = time.time()
+        self.stages = {}    # stage name -> {'seconds': ..., 'calls': ...}
+        self.counters = {}  # counter name -> count
+        self.bams = []      # one entry per BAM file counted
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+    def rename(self, name, newName):
+        '''Move the count of a counter to another one.'''
+        if name in self.counters:
+            self.count(newName, self.counters.pop(name))
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            stage['seconds'] += time.time() - start
+            stage['calls'] += 1
+    def addBam(self, bamFile, variants, seconds):
+        self.bams.append({ 'bam': bamFile, 'variants': variants, 'seconds': seconds,
+                           'variantsPerSecond': variants / seconds if seconds > 0 else None })
+    def addCounters(self, counters):
+        '''Add the counters of a worker process to these ones.'''
+        for name, amount in counters.items():
+            self.count(name, amount)
+    def report(self):
+        return { 'tool': self.tool, 'wallSeconds': time.time() - self.start,
+                 'stages': self.stages, 'counters': self.counters, 'bams': self.bams }
+    def write(self, filename):
+        with open(filename, 'w') as output:
+            json.dump(self.report(), output, indent=2, sort_keys=True)
 
-# compare two chromosome coordinates for ordering.
-def compareCoord(coord1, coord2):
-    chr1,pos1 = coord1[0].split(':')
-    chr2,pos2 = coord2[0].split(':')
-    if chr1 == chr2:
-        return cmp(int(pos1), int(pos2))
-    else:
-        return compareChrCode(chr1[3:], chr2[3:])
-
-def compareChrCode(code1, code2):
-    isNumerical1 = code1.isdigit()
-    isNumerical2 = code2.isdigit()
-    if isNumerical1:
-        if isNumerical2:
-            return cmp(int(code1), int(code2))
-        else:
-            return -1
+# The statistics of the current run, or None if they are not being recorded,
+# so that recording them costs no more than this test when they are not.
+runStats = None
+
+def startStats(tool):
+    global runStats
+    runStats = Stats(tool)
+
+def finishStats(filename):
+    if runStats:
+        runStats.write(filename)
+
+@contextmanager
+def statsStage(name):
+    '''Time a stage of the run, if the statistics are being recorded.'''
+    if runStats:
+        with runStats.stage(name):
+            yield
     else:
-        return cmp(code1, code2)
-
-def getEvidence(variantList, bamFilenames):
-    evidence = initEvidence(variantList)
-    # Iterate over sample BAM files.
-    for bamFile in bamFilenames:
-       with pysam.Samfile(bamFile, "rb") as bam:
-           # Count how many samples have each particular variant.
-           countVariants(evidence, variantList, bam)
+        yield
+
+def countStat(name, amount=1):
+    if runStats:
+        runStats.count(name, amount)
+
+def renameStat(name, newName):
+    if runStats:
+        runStats.rename(name, newName)
+
+def recordingStats():
+    return runStats != None
+
+def addWorkerCounters(counters):
+    '''Add the counters sent back by a worker process to the statistics of the run.'''
+    if runStats and counters:
+        runStats.addCounters(counters)
+
+def workerStats(recordStats):
+    '''Start counting afresh in a worker process, which starts with a copy of
+    the statistics of its parent.'''
+    global runStats
+    runStats = Stats('worker') if recordStats else None
+
+def takeWorkerCounters():
+    '''The counters of a worker process since the last call, to send back to the parent.'''
+    if runStats:
+        counters = runStats.counters
+        runStats.counters = {}
+        return counters
+    return None
+
+def sortByCoord(evidence, order=None):
+    '''Sort the (key, info) items of the evidence by coordinate. The chromosomes
+    are ranked once, so each variant is sorted on a pair of integers. The
+    evidence of a sorted variant list is already in order, so it is not sorted again.'''
+    if order is None:
+        order = defaultCoordOrder
+    items = evidence.items()
+    chromosomes = set(info.chromosome for key,info in items)
+    ranks = dict((chr, rank) for rank,chr in enumerate(sorted(chromosomes, key=order.chromosomeRank)))
+    keys = [(ranks[info.chromosome], info.position) for key,info in items]
+    if all(keys[n] <= keys[n+1] for n in xrange(len(keys) - 1)):
+        return items
+    return [item for key,item in sorted(zip(keys, items), key=itemgetter(0))]
+
+def chromosomeKey(chr):
+    '''Sort key for a chromosome name: the numbered chromosomes (chr1, chr2, ...)
+    in numerical order, followed by the others (chrM, chrX, ...) in alphabetical order.'''
+    code = chr[3:]
+    if code.isdigit():
+        return (0, int(code), '')
+    return (1, 0, code)
+
+# The order of chromosome coordinates. The chromosomes are in the same order
+# as a reference, if one is given, otherwise they are ordered by
+# chromosomeKey. Chromosomes which are not in the reference come after the
+# ones which are. The rank of each chromosome is only worked out once.
+class CoordOrder(object):
+    def __init__(self, referenceChromosomes=[]):
+        self.ranks = {}      # chromosome -> rank, for the chromosomes seen so far
+        self.reference = {}  # chromosome -> index in the reference
+        for index,chr in enumerate(referenceChromosomes):
+            self.reference.setdefault(chr, index)
+            # the variant rows name chromosomes with a "chr" prefix, which
+            # some references leave out
+            if not chr.startswith('chr'):
+                self.reference.setdefault('chr' + chr, index)
+    def chromosomeRank(self, chr):
+        rank = self.ranks.get(chr)
+        if rank is None:
+            index = self.reference.get(chr)
+            if index is None:
+                rank = (1, chromosomeKey(chr))
+            else:
+                rank = (0, index)
+            self.ranks[chr] = rank
+        return rank
+    def key(self, chr, position):
+        return (self.chromosomeRank(chr), position)
+    def idKey(self, id):
+        '''The sort key of a "chrN:pos" id.'''
+        chr, pos = id.split(':')
+        return self.key(chr, int(pos))
+
+defaultCoordOrder = CoordOrder()
+
+def readReferenceChromosomes(filename):
+    '''The chromosome names of a reference, in order, from the header of a BAM
+    file or from the first column of a FASTA index (.fai) file.'''
+    if filename.endswith('.bam'):
+        with pysam.Samfile(filename, "rb") as bam:
+            return list(bam.references)
+    with open(filename) as fai:
+        return [line.split('\t')[0] for line in fai if line.strip()]
+
+# Command line flags shared by the tools which gather evidence from BAM files.
+evidenceOptionsFlags = ["jobs=", "engine=", "region=", "shard=", "shardBy=",
+                        "evidenceCache=", "evidenceCacheSize=", "panel=", "reference=", "stats=",
+                        "prefetch=", "minBaseQual=", "minMapQual=", "flagFilter=", "maxDepth=",
+                        "adaptive", "adaptiveBlock=", "adaptiveOrder="]
+
+# A place to store command line arguments which control how evidence
+# is gathered from the sample BAM files. The Options of each tool which
+# calls getEvidence inherit from this class.
+class EvidenceOptions(object):
+    def __init__(self):
+        self.jobs = 1 # number of BAM files to process in parallel
+        self.engine = 'pileup' # how the variants are counted in each BAM file
+        self.region = None # only use variants in this (chromosome, start, end) region
+        self.shard = None # only use variants in this (shard, number of shards)
+        self.shardBy = 'window' # how the variants are split into shards
+        self.evidenceCache = None # file name of the evidence cache database
+        self.evidenceCacheSize = defaultEvidenceCacheSize # most counts to keep in the cache
+        self.panel = None # directory of a panel of comparators, used instead of BAM files
+        self.coordOrder = defaultCoordOrder # the order of the variants in the output
+        self.stats = None # file name of the JSON statistics report
+        self.prefetch = 0 # number of variants to read ahead in each BAM file, 0 for none
+        self.filters = PileupFilters() # the reads left out by the column engine
+        self.adaptive = False # stop counting each variant once its outcome is decided
+        self.adaptiveBlock = defaultAdaptiveBlock # number of variants counted adaptively at a time
+        self.adaptiveOrder = 'given' # the order of the BAM files when counting adaptively
+    def setEvidenceOption(self, o, a):
+        '''Record one of the evidenceOptionsFlags, returning False if o is not one of them.'''
+        if o == "--jobs":
+            self.jobs = safeReadInt(a)
+        elif o == "--engine":
+            if a not in evidenceEngines:
+                raise Exception, 'unknown evidence engine: ' + a
+            if a == 'column':
+                checkColumnEngine()
+            self.engine = a
+        elif o == "--region":
+            self.region = parseRegion(a)
+        elif o == "--shard":
+            self.shard = parseShard(a)
+        elif o == "--shardBy":
+            if a not in ['window', 'chromosome']:
+                raise Exception, 'unknown shardBy, expected window or chromosome: ' + a
+            self.shardBy = a
+        elif o == "--evidenceCache":
+            self.evidenceCache = a
+        elif o == "--evidenceCacheSize":
+            self.evidenceCacheSize = safeReadInt(a)
+        elif o == "--panel":
+            self.panel = a
+        elif o == "--reference":
+            self.coordOrder = CoordOrder(readReferenceChromosomes(a))
+        elif o == "--stats":
+            self.stats = a
+        elif o == "--prefetch":
+            self.prefetch = safeReadInt(a)
+        elif o == "--adaptive":
+            self.adaptive = True
+        elif o == "--adaptiveBlock":
+            self.adaptiveBlock = safeReadInt(a)
+            if self.adaptiveBlock < 1:
+                raise Exception, 'adaptiveBlock must be at least 1: ' + a
+        elif o == "--adaptiveOrder":
+            if a not in adaptiveOrders:
+                raise Exception, 'unknown adaptiveOrder, expected given or hits: ' + a
+            self.adaptiveOrder = a
+        elif not self.filters.setOption(o, a):
+            return False
+        return True
+
+def getEvidence(variantList, bamFilenames, options=None, decided=None, counter=None):
+    '''The evidence of the variants in the BAM files. With --adaptive, a
+    variant is not counted in any more BAM files once decided(counts,
+    totalSamples) is True of its counts so far (see adaptiveEvidence).
+    The BAM files are counted with the counter if one is given, so that
+    runs which get the evidence of many variant lists in turn keep one
+    pool of workers and evidence cache (see BamCounter).'''
+    if options is None:
+        options = EvidenceOptions()
+    with statsStage('getEvidence'):
+        return gatherEvidence(variantList, bamFilenames, options, decided, counter)
+
+def gatherEvidence(variantList, bamFilenames, options, decided=None, counter=None):
+    # parse the variants once, rather than once for each BAM file
+    table = VariantTable(variantList)
+    evidence = initEvidence(table)
+    if options.adaptive and decided != None:
+        adaptiveEvidence(evidence, table, bamFilenames, options, decided, counter)
+        return evidence
+    for counts in sampleCounts(table, bamFilenames, options, counter):
+        # Count how many samples have each particular variant.
+        addCounts(evidence, table, counts)
     return evidence
 
+def getBatchEvidence(variantLists, bamFilenames, options=None):
+    '''The evidence of each of several variant lists, as getEvidence would
+    give it. The variants of all of the lists are counted together, so each
+    BAM file is read once, and each distinct site in it is only tallied
+    once, however many of the lists have variants at it.'''
+    if options is None:
+        options = EvidenceOptions()
+    with statsStage('getEvidence'):
+        table = VariantTable()
+        # the variants of each list in the table
+        tables = []
+        for variantList in variantLists:
+            start = len(table)
+            table.extend(variantList)
+            tables.append((start, table.subset(xrange(start, len(table)))))
+        evidences = [initEvidence(listTable) for listStart,listTable in tables]
+        for counts in sampleCounts(table, bamFilenames, options):
+            for (start,listTable),evidence in zip(tables, evidences):
+                addCounts(evidence, listTable, counts[start:start + len(listTable)])
+        return evidences
+
+# the orders of the BAM files when counting adaptively: as given on the
+# command line, or the BAM files where the most variants were found first
+adaptiveOrders = ['given', 'hits']
+# the number of variants counted adaptively at a time, unless told otherwise
+defaultAdaptiveBlock = 4096
+# the count of a variant in the BAM files it was not counted in
+skippedCount = (0, 0)
+
+def adaptiveEvidence(evidence, table, bamFilenames, options, decided, counter=None):
+    '''Count the variants of the table in blocks of options.adaptiveBlock
+    variants. Each block is counted in options.jobs BAM files at a time, and
+    only the variants which are not decided yet are counted in the next
+    ones. A variant is given skippedCount in the BAM files it was not
+    counted in, so decided must only be True when those counts can not
+    change its outcome. With --adaptiveOrder=hits, the BAM files are sorted
+    before each block by the share of the variants counted in them so far
+    which had a read with the variant base, so the BAM files which decide
+    the most variants are read first. The pool of workers, the evidence
+    cache and the open BAM files are kept for the whole run (see BamCounter),
+    or those of the counter are used if one is given.'''
+    if options.panel:
+        raise Exception, '--adaptive can not be used with a panel'
+    if counter != None:
+        adaptiveBlocks(evidence, table, bamFilenames, options, decided, counter)
+        return
+    counter = BamCounter(bamFilenames, options)
+    try:
+        adaptiveBlocks(evidence, table, bamFilenames, options, decided, counter)
+    finally:
+        counter.close()
+
+def adaptiveBlocks(evidence, table, bamFilenames, options, decided, counter):
+    '''Count the blocks of variants of adaptiveEvidence with the counter.'''
+    order = range(len(bamFilenames))
+    hits = [0] * len(bamFilenames)     # variants with a read with the variant base, in each BAM file
+    counted = [0] * len(bamFilenames)  # variants counted in each BAM file
+    roundSize = max(1, options.jobs)
+    for blockStart in xrange(0, len(table), options.adaptiveBlock):
+        blockIndices = range(blockStart, min(blockStart + options.adaptiveBlock, len(table)))
+        # the counts of each variant of the block, in the order of the BAM files
+        blockCounts = [[None] * len(bamFilenames) for index in blockIndices]
+        if options.adaptiveOrder == 'hits':
+            order.sort(key=lambda bam: -float(hits[bam]) / counted[bam] if counted[bam] else 0.0)
+        undecided = range(len(blockIndices))
+        for roundStart in xrange(0, len(order), roundSize):
+            if not undecided:
+                break
+            roundBams = order[roundStart:roundStart + roundSize]
+            roundTable = table.subset([blockIndices[n] for n in undecided])
+            roundCounts = list(counter.counts(roundTable, [bamFilenames[bam] for bam in roundBams]))
+            for bam,counts in zip(roundBams, roundCounts):
+                for n,count in zip(undecided, counts):
+                    blockCounts[n][bam] = count
+                    if count[0] > 0:
+                        hits[bam] += 1
+                counted[bam] += len(undecided)
+            undecided = [n for n in undecided if not
+                         decided([count for count in blockCounts[n] if count != None], len(bamFilenames))]
+        for index,counts in zip(blockIndices, blockCounts):
+            skipped = counts.count(None)
+            if skipped:
+                countStat('counts skipped', skipped)
+            evidence[index].counts = [skippedCount if count == None else count for count in counts]
+
+def sampleCounts(table, bamFilenames, options, counter=None):
+    '''Yield the counts of the variants of the table in each sample, in order:
+    the comparators of the panel, or else the BAM files, counted with the
+    counter if one is given.'''
+    if options.panel:
+        if bamFilenames:
+            raise Exception, 'give either a panel or BAM files, not both'
+        panel = Panel(options.panel)
+        checkPanelOptions(options, panel)
+        # look up the counts of every comparator in the panel, instead
+        # of counting the variants in the BAM files
+        for counts in panel.counts(table):
+            yield counts
+    elif counter != None:
+        for counts in counter.counts(table, bamFilenames):
+            yield counts
+    elif options.evidenceCache:
+        cache = EvidenceCache(options.evidenceCache, options.evidenceCacheSize)
+        try:
+            for counts in cachedBamCounts(cache, table, bamFilenames, options):
+                yield counts
+        finally:
+            cache.close()
+    else:
+        # Iterate over sample BAM files.
+        for counts in countBamFiles(bamFilenames, [table] * len(bamFilenames), options):
+            yield counts
+
+def checkPanelOptions(options, panel):
+    '''Reject the options which change how the BAM files are counted, which
+    a panel has already done. The engine may be the panel's own, or the
+    default pileup engine, which gives the same counts as the sweep engine.'''
+    if not options.filters.isDefault():
+        raise Exception, 'the read filters can not be used with a panel'
+    if options.engine not in ['pileup', panel.engine]:
+        raise Exception, 'the panel %s was counted with --engine=%s, not %s' % \
+            (options.panel, panel.engine, options.engine)
+    if options.prefetch > 0:
+        raise Exception, '--prefetch can not be used with a panel'
+    if options.evidenceCache:
+        raise Exception, '--evidenceCache can not be used with a panel'
+
+def addCounts(evidence, table, counts):
+    '''Add the counts from one BAM file, one per variant in the table, to the evidence.'''
+    for index,count in enumerate(counts):
+        evidence[index].counts.append(count)
+
+def cachedBamCounts(cache, table, bamFilenames, options, countFiles=None):
+    '''Yield the counts of every variant in the table for each BAM file, in
+    order, only counting the variants which are not in the cache, with
+    countFiles (countBamFiles by default).'''
+    if countFiles is None:
+        countFiles = countBamFiles
+    bamKeys = [cache.bamKey(bamFile, evidenceSettings(options)) for bamFile in bamFilenames]
+    cachedCounts = [cache.lookup(bamKey, table) for bamKey in bamKeys]
+    # the variants of each BAM file which are not in the cache
+    missingIndices = [[index for index,count in enumerate(counts) if count == None]
+                      for counts in cachedCounts]
+    missingTables = [table.subset(indices) for indices in missingIndices]
+    newCounts = countFiles(bamFilenames, missingTables, options)
+    for bamKey,counts,indices,missingTable,missing in \
+            zip(bamKeys, cachedCounts, missingIndices, missingTables, newCounts):
+        for index,count in zip(indices, missing):
+            counts[index] = count
+        cache.store(bamKey, missingTable, missing)
+        yield counts
+
+def evidenceSettings(options):
+    '''The options which change the counts, as part of the evidence cache key.'''
+    if options.engine in filteringEngines:
+        return 'engine=%s,%s' % (options.engine, options.filters.settings())
+    return 'engine=%s' % options.engine
+
+def countBamFiles(bamFilenames, tables, options):
+    '''Yield the counts of the variants in each BAM file, in order, where
+    tables[n] is the VariantTable of the variants to count in bamFilenames[n].'''
+    checkReadFilters(options)
+    if options.jobs > 1 and len(bamFilenames) > 1:
+        for counts in countBamFilesParallel(bamFilenames, tables, options):
+            yield counts
+    else:
+        for counts in countBamFilesSerial(bamFilenames, tables, options):
+            yield counts
+
+def checkReadFilters(options):
+    if options.engine not in filteringEngines and not options.filters.isDefault():
+        raise Exception, 'the read filters are only used by --engine=column'
+
+def countBamFilesSerial(bamFilenames, tables, options, openBams=None):
+    '''Count the variants in each BAM file in turn, keeping the BAM files
+    open in openBams (see countingBam), if it is given.'''
+    for bamFile,table in zip(bamFilenames, tables):
+        # skip BAM files with nothing to count (everything was cached)
+        if len(table) == 0:
+            yield []
+            continue
+        start = time.time()
+        with countingBam(bamFile, openBams) as bam:
+            counts = list(countTable(table, bam, bamFile, options.engine, options.prefetch, options.filters))
+        if runStats:
+            runStats.addBam(bamFile, len(table), time.time() - start)
+        yield counts
+
+@contextmanager
+def countingBam(bamFile, openBams=None):
+    '''Open a BAM file for counting. With openBams, a dict of BAM file name
+    to open BAM file, the BAM file is only opened the first time, and is
+    left open afterwards.'''
+    if openBams is None:
+        with pysam.Samfile(bamFile, "rb") as bam:
+            yield bam
+    else:
+        bam = openBams.get(bamFile)
+        if bam is None:
+            bam = openBams[bamFile] = pysam.Samfile(bamFile, "rb")
+        yield bam
+
+def countBamFilesParallel(bamFilenames, tables, options):
+    '''Count the variants in a pool of worker processes, one BAM file per task.'''
+    # the workers get the most common table once when they start, so it
+    # is not sent along with every BAM file
+    sharedTable = tables[0]
+    tasks = [(bamFile, None if table is sharedTable else table)
+             for bamFile,table in zip(bamFilenames, tables)]
+    pool = multiprocessing.Pool(processes = min(options.jobs, len(bamFilenames)),
+                                initializer = initEvidenceWorker,
+                                initargs = (sharedTable, options.engine, options.prefetch, options.filters,
+                                            recordingStats()))
+    try:
+        for counts in poolCounts(pool, bamFilenames, tasks):
+            yield counts
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def poolCounts(pool, bamFilenames, tasks):
+    '''Yield the counts of the countBamFile tasks of a pool, one per BAM file.'''
+    # imap yields the results in the order of the BAM files, so the
+    # counts for each variant are in the same sample order as a serial run.
+    for bamFile,(counts,seconds,counters) in izip(bamFilenames, pool.imap(countBamFile, tasks)):
+        if runStats:
+            runStats.addBam(bamFile, len(counts) / 2, seconds)
+        addWorkerCounters(counters)
+        yield [(counts[2*index], counts[2*index+1]) for index in xrange(len(counts) / 2)]
+
+# Counts many variant tables in the same BAM files, one call after another,
+# as adaptiveEvidence does. The pool of worker processes (with --jobs), the
+# evidence cache (with --evidenceCache) and the open BAM files are kept
+# from one call to the next, instead of being made again for each one.
+class BamCounter(object):
+    def __init__(self, bamFilenames, options):
+        checkReadFilters(options)
+        self.options = options
+        self.openBams = {}  # BAM file name -> open BAM file, in a serial run
+        self.cache = None
+        self.pool = None
+        if options.evidenceCache:
+            self.cache = EvidenceCache(options.evidenceCache, options.evidenceCacheSize)
+        if options.jobs > 1 and len(bamFilenames) > 1:
+            # the tables differ from call to call, so each task has its own,
+            # and the workers keep their BAM files open
+            self.pool = multiprocessing.Pool(processes = min(options.jobs, len(bamFilenames)),
+                                             initializer = initEvidenceWorker,
+                                             initargs = (None, options.engine, options.prefetch, options.filters,
+                                                         recordingStats(), True))
+    def counts(self, table, bamFilenames):
+        '''Yield the counts of the variants of the table in each BAM file, in order.'''
+        if self.cache:
+            return cachedBamCounts(self.cache, table, bamFilenames, self.options, self.countBamFiles)
+        return self.countBamFiles(bamFilenames, [table] * len(bamFilenames), self.options)
+    def countBamFiles(self, bamFilenames, tables, options):
+        '''The same as countBamFiles, with the pool and open BAM files of the counter.'''
+        if self.pool:
+            return poolCounts(self.pool, bamFilenames, zip(bamFilenames, tables))
+        return countBamFilesSerial(bamFilenames, tables, options, self.openBams)
+    def close(self):
+        if self.pool:
+            # the workers close their BAM files when they exit
+            self.pool.close()
+            self.pool.join()
+        if self.cache:
+            self.cache.close()
+        for bam in self.openBams.values():
+            bam.close()
+
+# The variant table, evidence engine, prefetch depth and read filters for the
+# current worker process, set once when the worker starts, rather than being
+# sent along with every BAM file. The open BAM files of the worker, if it
+# keeps them open between tasks.
+workerTable = None
+workerEngine = None
+workerPrefetch = 0
+workerFilters = None
+workerBams = None
+
+def initEvidenceWorker(table, engine, prefetch=0, filters=None, recordStats=False, keepBamsOpen=False):
+    global workerTable, workerEngine, workerPrefetch, workerFilters, workerBams
+    workerTable = table
+    workerEngine = engine
+    workerPrefetch = prefetch
+    workerFilters = filters
+    workerBams = {} if keepBamsOpen else None
+    workerStats(recordStats)
+
+def countBamFile(task):
+    '''Count the variants in one BAM file, returning a flat array of
+    sameAsVariant,coverage pairs, one pair per variant in the table, the
+    time it took, and the statistics counters of the worker. The task is a
+    BAM file name and a VariantTable, or None for the worker table.'''
+    bamFile, table = task
+    if table == None:
+        table = workerTable
+    start = time.time()
+    counts = array('l')
+    if len(table) > 0:
+        with countingBam(bamFile, workerBams) as bam:
+            for sameAsVariant,coverage in countTable(table, bam, bamFile, workerEngine, workerPrefetch, workerFilters):
+                counts.append(sameAsVariant)
+                counts.append(coverage)
+    return counts, time.time() - start, takeWorkerCounters()
+
+# The engines which seek to each site in turn, so reading ahead of the site
+# being tallied helps them. The sweep engine reads each cluster of sites in
+# one go.
+prefetchEngines = ['pileup', 'fetch', 'column']
+
+def countTable(table, bam, bamFile, engine, prefetch=0, filters=None):
+    '''Yield the (sameAsVariant, coverage) of each variant of the table in an
+    open BAM file. Each distinct site (chromosome and position) is tallied
+    once by the engine, and every variant at the site, whatever its variant
+    base, is counted from that tally. Reads up to prefetch sites ahead in
+    background threads. The read filters are only given to the filteringEngines.'''
+    sites, siteIndices = table.sites()
+    if runStats:
+        runStats.count('sites tallied', len(sites))
+    if engine in filteringEngines:
+        tallies = evidenceEngines[engine](sites, bam, filters)
+    else:
+        tallies = evidenceEngines[engine](sites, bam)
+    if prefetch > 0 and engine in prefetchEngines and canPrefetch(bamFile):
+        regions = [(sites.chromosome(index), sites.positions[index] - 1, sites.positions[index])
+                   for index in xrange(len(sites))]
+        tallies = prefetching(tallies, Prefetcher(bamFile, bam.references, regions, prefetch))
+    return countsFromTallies(table, siteIndices, iter(tallies))
+
+def countsFromTallies(table, siteIndices, tallies):
+    '''Yield the (sameAsVariant, coverage) of each variant in the table from
+    the tally of its site. The tallies come in the order of the sites.'''
+    # the tallies of the sites so far, one after the other
+    siteTallies = array('I')
+    for index in xrange(len(table)):
+        start = siteIndices[index] * tallySize
+        if start == len(siteTallies):
+            siteTallies.extend(next(tallies))
+        yield (siteTallies[start + tallyBaseIndex[table.variantBases[index]]],
+               siteTallies[start + tallyCoverage])
+    # finish the tallies, so that the engine can tidy up (see prefetching)
+    for tally in tallies:
+        pass
+
+def sortedVariantChunks(variantRows, chunkSize, order=defaultCoordOrder):
+    '''Split the rows of a coordinate sorted variant file into lists of about
+    chunkSize rows, reading the rows lazily. Variants with the same
+    coordinates are never split across chunks, so each chunk can be filtered
+    on its own. Raises an exception if the variants are not sorted in the order.'''
+    chunk = []
+    lastId = None
+    lastKey = None
+    for row in variantRows:
+        info = parseVariantRow(row)
+        if info:
+            if lastId != None:
+                key = order.key(info.chromosome, info.position)
+                if key < lastKey:
+                    raise Exception, 'variants are not sorted by coordinate: %s comes after %s' % (info.id, lastId)
+                # start a new chunk once this one is full, but only between
+                # two different coordinates
+                if key > lastKey and len(chunk) >= chunkSize:
+                    yield chunk
+                    chunk = []
+            lastId = info.id
+            lastKey = order.key(info.chromosome, info.position)
+        chunk.append(row)
+    if chunk:
+        yield chunk
+
+def parseRegion(s):
+    '''Parse a chr:start-end region, or a whole chromosome, into (chromosome, start, end),
+    where the coordinates are 1-based and inclusive.'''
+    if ':' in s:
+        chr, startEnd = s.split(':', 1)
+        startEnd = startEnd.replace(',', '').split('-')
+        if len(startEnd) != 2:
+            raise Exception, 'bad region, expected chr:start-end: ' + s
+        start, end = safeReadInt(startEnd[0]), safeReadInt(startEnd[1])
+    else:
+        chr, start, end = s, 1, sys.maxint
+    # variant ids always have the chr prefix
+    if not chr.startswith('chr'):
+        chr = 'chr' + chr
+    return (chr, start, end)
+
+def parseShard(s):
+    '''Parse an i/N shard, where i counts from 1 to N.'''
+    shardCount = s.split('/')
+    if len(shardCount) != 2:
+        raise Exception, 'bad shard, expected i/N: ' + s
+    shard, count = safeReadInt(shardCount[0]), safeReadInt(shardCount[1])
+    if shard < 1 or shard > count:
+        raise Exception, 'bad shard, i must be between 1 and N: ' + s
+    return (shard, count)
+
+def selectVariants(variantList, options):
+    '''Keep the valid variants in the region and shard of this run, or all
+    the rows if there is no region or shard.'''
+    selector = variantSelector(options, variantList)
+    if selector == None:
+        return variantList
+    return [row for row in variantList if selector.selects(row)]
+
+def variantSelector(options, variantRows):
+    '''Make the VariantSelector for the region and shard of this run, or None
+    if every variant is used. The variantRows are only read when sharding.'''
+    if options.region == None and options.shard == None:
+        return None
+    return VariantSelector(options.region, options.shard, options.shardBy, variantRows)
+
+# Decides which variants are in the region and shard of this run.
+# Sharding by window splits the sorted variants into N contiguous windows
+# with (about) the same number of variants in each. Sharding by chromosome
+# gives each shard whole chromosomes, starting with the chromosome with most
+# variants, and always adding to the shard with fewest variants so far.
+# Either way, variants with the same coordinates are always in the same shard,
+# and every run with the same variants and N splits them in the same way.
+class VariantSelector(object):
+    def __init__(self, region, shard, shardBy, variantRows):
+        self.region = region
+        self.shard = shard
+        if shard != None:
+            # the rows are read lazily, keeping only the ids or chromosomes
+            infos = (info for info in (parseVariantRow(row) for row in variantRows)
+                     if info and self.inRegion(info))
+            shardNumber, shardCount = shard
+            if shardBy == 'window':
+                self.windowStarts = windowStarts((info.id for info in infos), shardCount)
+            else:
+                self.chromosomeShards = chromosomeShards((info.chromosome for info in infos), shardCount)
+            self.shardBy = shardBy
+    def inRegion(self, info):
+        if self.region == None:
+            return True
+        chr, start, end = self.region
+        return info.chromosome == chr and start <= info.position <= end
+    def selects(self, row):
+        info = parseVariantRow(row)
+        if not info or not self.inRegion(info):
+            return False
+        if self.shard == None:
+            return True
+        shardNumber, shardCount = self.shard
+        if self.shardBy == 'window':
+            return bisect.bisect_right(self.windowStarts, coordSortKey(info.id)) == shardNumber - 1
+        else:
+            return self.chromosomeShards.get(info.chromosome) == shardNumber
+
+# sort key for "chrN:pos" ids, in the default coordinate order
+def coordSortKey(id):
+    return defaultCoordOrder.idKey(id)
+
+def windowStarts(ids, shardCount):
+    '''The sort key of the first variant of each window after the first, splitting
+    the ids into shardCount windows of about the same size.'''
+    uniqueIds = sorted(set(ids), key=coordSortKey)
+    return [coordSortKey(uniqueIds[(len(uniqueIds) * n) / shardCount])
+            for n in range(1, shardCount) if uniqueIds]
+
+def chromosomeShards(chromosomes, shardCount):
+    '''Give each chromosome a shard number, balancing the number of variants per shard.'''
+    variantCounts = {}
+    for chr in chromosomes:
+        variantCounts[chr] = variantCounts.get(chr, 0) + 1
+    # biggest chromosomes first, ties in chromosome order
+    byCount = sorted(variantCounts.items(),
+        key=lambda (chr, count): (-count, chromosomeKey(chr)))
+    # a heap of (variants so far, shard number)
+    shards = [(0, n) for n in range(1, shardCount + 1)]
+    assigned = {}
+    for chr, count in byCount:
+        total, shard = heapq.heappop(shards)
+        assigned[chr] = shard
+        heapq.heappush(shards, (total + count, shard))
+    return assigned
+
 class EvidenceInfo(object):
-    def __init__(self, inputRow, counts):
+    def __init__(self, inputRow, counts, chromosome=None, position=None, id=None):
         self.inputRow = inputRow
         self.counts = counts
+        self.id = id # the "chrN:pos" id of the variant
+        # the coordinates of the variant, to sort on
+        self.chromosome = chromosome
+        self.position = position
 
-def initEvidence(variantList):
-    '''Initialise the frequency counter for each variant to be zero.'''
-    evidence = {}
-    for variant in variantList:
-        info = parseVariantRow(variant)
-        if info:
-            evidence[info.id] = EvidenceInfo(inputRow = info.inputRow, counts = [])
+# The evidence of a list of variants: a dict which gives its keys (and
+# items and values) in the order they were added, from a list of the keys.
+class Evidence(dict):
+    def __init__(self):
+        dict.__init__(self)
+        self.order = []
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.order.append(key)
+        dict.__setitem__(self, key, value)
+    def __iter__(self):
+        return iter(self.order)
+    def keys(self):
+        return list(self.order)
+    def values(self):
+        return [self[key] for key in self.order]
+    def items(self):
+        return [(key, self[key]) for key in self.order]
+
+def initEvidence(table):
+    '''Initialise the frequency counter for each variant in the table to be zero.
+    The variants are kept in the order of the table, keyed by their index in
+    it, so that variants at the same site each keep their own counts.'''
+    evidence = Evidence()
+    for index in xrange(len(table)):
+        evidence[index] = EvidenceInfo(inputRow = table.inputRows[index], counts = [],
+                                       chromosome = table.chromosome(index),
+                                       position = table.positions[index],
+                                       id = table.ids[index])
     return evidence
 
+# The valid variants of a variant list, parsed once into parallel arrays
+# (one entry per variant, in list order), so that every BAM file can be
+# counted without parsing the variant rows again.
+class VariantTable(object):
+    def __init__(self, variantList=[]):
+        self.chromosomes = []            # chromosome names, indexed by chromosome id
+        self.chromosomeIds = array('i')  # the chromosome id of each variant
+        self.positions = array('l')      # 1-based position of each variant
+        self.variantBases = array('c')   # the variant base of each variant
+        self.ids = []                    # "chrN:pos" id of each variant
+        self.inputRows = []              # the input row of each variant
+        self.extend(variantList)
+    def extend(self, variantList):
+        '''Add the valid variants of a variant list to the end of the table.'''
+        chromosomeIds = dict((chr, id) for id,chr in enumerate(self.chromosomes))
+        for variant in variantList:
+            info = parseVariantRow(variant)
+            # only keep valid rows in the variant TSV file
+            if info:
+                if info.chromosome not in chromosomeIds:
+                    chromosomeIds[info.chromosome] = len(self.chromosomes)
+                    self.chromosomes.append(info.chromosome)
+                self.chromosomeIds.append(chromosomeIds[info.chromosome])
+                self.positions.append(info.position)
+                self.variantBases.append(info.variantBase)
+                self.ids.append(info.id)
+                self.inputRows.append(info.inputRow)
+    def __len__(self):
+        return len(self.ids)
+    def chromosome(self, index):
+        return self.chromosomes[self.chromosomeIds[index]]
+    def subset(self, indices):
+        '''A new table of the variants at the given indices of this table.'''
+        table = VariantTable()
+        table.chromosomes = self.chromosomes
+        for index in indices:
+            table.chromosomeIds.append(self.chromosomeIds[index])
+            table.positions.append(self.positions[index])
+            table.variantBases.append(self.variantBases[index])
+            table.ids.append(self.ids[index])
+            table.inputRows.append(self.inputRows[index])
+        return table
+    def sites(self):
+        '''A table of the distinct sites (chromosome and position) of the
+        variants, in the order they first appear, each with the first variant
+        at it, and the index in that table of the site of each variant.'''
+        siteOf = {}
+        firstIndices = []
+        siteIndices = array('l')
+        for index in xrange(len(self)):
+            key = (self.chromosomeIds[index], self.positions[index])
+            siteIndex = siteOf.get(key)
+            if siteIndex is None:
+                siteIndex = siteOf[key] = len(firstIndices)
+                firstIndices.append(index)
+            siteIndices.append(siteIndex)
+        return self.subset(firstIndices), siteIndices
+
 def showEvidence(evidence):
     '''Print out the frequency counter for each variant.'''
-    for chrPos,info in evidence.items():
+    for index,info in evidence.items():
         print("%s %s" % (info.inputRow,str(info.counts)))
 
-def countVariants(evidence, variantList, bam):
-    '''For each variant in the list, check if it is evident in this particular sample BAM.'''
-    for variant in variantList:
-        info = parseVariantRow(variant)
-        # only process valid rows in the variant TSV file
-        if info:
-            # get the pileup information for this particular variant coordinates
-            # the pileup tells us what base was called in each of the reads at
-            # this particular coordinate
-            pileupCol = lookupPileup(bam, info.chromosome, info.position)
-            sameAsVariant = 0
-            coverage = 0
-            unknown_size_reads = 0 # number of variants on a read of unknown size
-            if pileupCol:
-                pos,coverage,reads = pileupCol
-                # Count the number of reads that are the same as the variant
-                for pileupread in reads:
-                    readBase = pileupread.alignment.seq[pileupread.qpos]
-                    # check if the sample base (at the same position) is the same as the variant base
-                    # but skip reads which are marked as "is_del", deletions
-                    if not pileupread.is_del and readBase == info.variantBase:
-                        sameAsVariant += 1
-            evidence[info.id].counts.append((sameAsVariant,coverage))
+def countVariants(evidence, table, bam, bamFile, engine='pileup'):
+    '''For each variant in the table, check if it is evident in this particular sample BAM.'''
+    addCounts(evidence, table, countTable(table, bam, bamFile, engine))
+
+def pileupTallies(sites, bam):
+    '''Yield the tally (see tallyPileupColumn) of each site in the table, in order.'''
+    for index in xrange(len(sites)):
+        # get the pileup information for this particular variant coordinates
+        # the pileup tells us what base was called in each of the reads at
+        # this particular coordinate
+        pileupCol = lookupPileup(bam, sites.chromosome(index), sites.positions[index])
+        yield tallyPileupColumn(pileupCol)
+
+def tallyPileupColumn(pileupCol):
+    '''Count the reads in a pileup column with each base, the reads with a
+    deletion, and the coverage, as an array in the order of a panel tally:
+    A, C, G, T, deletions, coverage. Reads which are marked as "is_del"
+    (deletions) count towards the coverage, but never match a variant base.'''
+    tally = array('I', [0] * tallySize)
+    if pileupCol:
+        pos,coverage,reads = pileupCol
+        tally[tallyCoverage] = coverage
+        if runStats:
+            runStats.count('reads inspected', len(reads))
+        for pileupread in reads:
+            if pileupread.is_del:
+                tally[tallyDeletions] += 1
+            else:
+                index = tallyBaseIndex.get(pileupread.alignment.seq[pileupQueryPosition(pileupread)])
+                if index != None:
+                    tally[index] += 1
+    return tally
+
+def pileupQueryPosition(pileupread):
+    '''The offset in its read of the base of a pileup read, which is qpos in
+    older versions of pysam, and query_position in newer ones.'''
+    qpos = getattr(pileupread, 'qpos', None)
+    return qpos if qpos != None else pileupread.query_position
+
+def tallyPositions(bam, chr, positions):
+    '''Yield the tally of each of the sorted (1-based) positions on a
+    chromosome, walking the pileup once for each cluster of nearby positions.'''
+    wanted = set(positions)
+    tallies = {}
+    for start,end in clusterPositions(positions, sweepRegionGap):
+        for pileupCol in sweepPileup(bam, chr, start, end):
+            if pileupCol[0] + 1 in wanted:
+                tallies[pileupCol[0] + 1] = tallyPileupColumn(pileupCol)
+    for position in positions:
+        tally = tallies.get(position)
+        yield tally if tally != None else tallyPileupColumn(None)
+
+# Variants on the same chromosome which are at most this many bases apart
+# are counted in the same sweep of the pileup.
+sweepRegionGap = 1000
+
+def sweepTallies(sites, bam):
+    '''The same as pileupTallies, but walks the pileup once per cluster of nearby
+    sites, instead of looking up a separate pileup for every site.'''
+    # the positions of the sites, grouped by chromosome
+    positions = {}
+    for index in xrange(len(sites)):
+        positions.setdefault(sites.chromosome(index), []).append(sites.positions[index])
+    tallies = {}
+    for chr,chrPositions in positions.items():
+        chrPositions.sort()
+        for position,tally in izip(chrPositions, tallyPositions(bam, chr, chrPositions)):
+            tallies[(chr, position)] = tally
+    return [tallies[(sites.chromosome(index), sites.positions[index])] for index in xrange(len(sites))]
+
+def clusterPositions(positions, gap):
+    '''Group sorted positions into (start, end) regions, splitting wherever
+    consecutive positions are more than gap bases apart.'''
+    regions = []
+    for position in positions:
+        if regions and position - regions[-1][1] <= gap:
+            regions[-1][1] = position
+        else:
+            regions.append([position, position])
+    return regions
+
+def sweepPileup(bam, chr, start, end):
+    '''Yield the pileup for every column from start to end (1-based, inclusive)
+    of a chromosome, in the same form as lookupPileup.'''
+    if runStats:
+        runStats.count('pileup sweeps')
+    for pileupcolumn in bam.pileup(chr, start-1, end):
+        if runStats:
+            runStats.count('pileup columns visited')
+        # as in lookupPileup, samtools may give back columns outside the region
+        if start-1 <= pileupcolumn.pos < end:
+            # the column is only valid until the iterator advances (see lookupPileup)
+            yield (pileupcolumn.pos, pileupcolumn.n, pileupcolumn.pileups)
 
 class VariantInfo(object):
     '''Interesting information about a particular variant.'''
@@ -135,13 +998,202 @@ def lookupPileup(bam, chr, col):
     # assume argument is in 1-based numbering.
     # samtools gives back a range of pilups that cover the requested coordinates,
     # (no idea why) so we have to search for the particular one we want
+    columns = 0
     for pileupcolumn in bam.pileup(chr, col-1, col):
+        columns += 1
         if pileupcolumn.pos == col-1:
+            if runStats:
+                runStats.count('pileup lookups')
+                runStats.count('pileup columns visited', columns)
             # XXX can't return pileupcolumn here because: segfault!
             # this appears to be a bug in either pysam or samtools (or both)
             return (pileupcolumn.pos , pileupcolumn.n, pileupcolumn.pileups)
+    if runStats:
+        runStats.count('pileup lookups')
+        runStats.count('pileup columns visited', columns)
+    return None
+
+def fetchTallies(sites, bam):
+    '''The same as pileupTallies, but tallies the reads overlapping each site
+    directly, instead of building a pileup column for it.'''
+    for index in xrange(len(sites)):
+        yield tallyFetchedReads(bam, sites.chromosome(index), sites.positions[index])
+
+# Reads with any of these flags (unmapped, secondary, QC fail, duplicate)
+# are left out of the pileup by samtools, so they are skipped here too.
+pileupSkipFlags = 0x4 | 0x100 | 0x200 | 0x400
+# The least base quality of a base in the pileup of pysam. Reads with a
+# lower quality base at a position still count towards its coverage.
+pileupMinBaseQuality = 13
+
+def tallyFetchedReads(bam, chr, position):
+    '''Tally the reads covering a (1-based) position, to match tallyPileupColumn.
+    Unlike the pileup, the depth of the position is not capped.'''
+    tally = array('I', [0] * tallySize)
+    for read in bam.fetch(chr, position-1, position):
+        if runStats:
+            runStats.count('reads inspected')
+        if read.flag & pileupSkipFlags:
+            continue
+        aligned = queryPosition(read, position-1)
+        if aligned is not None:
+            qpos,isDel = aligned
+            tally[tallyCoverage] += 1
+            # as in the pileup, a base below the least quality is left out,
+            # and so is a deletion when the base after it is; a base without
+            # a quality is left out too, as the pileup does
+            quality = baseQuality(read, qpos)
+            if quality == None or quality < pileupMinBaseQuality:
+                continue
+            # reads with a deletion at the position are "is_del" in the pileup,
+            # they count towards the coverage but never match the variant
+            if isDel:
+                tally[tallyDeletions] += 1
+            else:
+                baseIndex = tallyBaseIndex.get(read.seq[qpos])
+                if baseIndex != None:
+                    tally[baseIndex] += 1
+    return tally
+
+def baseQuality(read, qpos):
+    '''The quality of a base of a read, or None if the read has no qualities
+    or no base there. The pileup leaves out a base without a quality unless
+    its least base quality is 0.'''
+    qual = read.qual
+    if qual and qpos < len(qual):
+        return ord(qual[qpos]) - 33
+    return None
+
+def queryPosition(read, refPos):
+    '''Find the offset in the read sequence which is aligned to the 0-based
+    reference position by walking the CIGAR string. Returns (offset, isDel),
+    where isDel is True if the read has a deletion or skip at the position,
+    and the offset is then that of the next base of the read, as in the
+    pileup. Returns None if the read does not cover the position.'''
+    readRefPos = read.pos
+    queryPos = 0
+    for op,length in read.cigar:
+        # M, = and X consume both the reference and the query
+        if op in (0, 7, 8):
+            if refPos < readRefPos + length:
+                return (queryPos + (refPos - readRefPos), False)
+            readRefPos += length
+            queryPos += length
+        # I and S consume only the query
+        elif op in (1, 4):
+            queryPos += length
+        # D and N consume only the reference
+        elif op in (2, 3):
+            if refPos < readRefPos + length:
+                return (queryPos, True)
+            readRefPos += length
+        # H and P consume neither
     return None
 
+# The most reads in a pileup column, as in samtools.
+defaultMaxDepth = 8000
+
+class PileupFilters(object):
+    '''The reads left out of the pileup by the column engine: bases below a
+    base quality, reads below a mapping quality or with any of the flags,
+    and reads beyond the most in a column. The defaults are the same as the
+    pileup of the other engines.'''
+    def __init__(self):
+        self.minBaseQual = pileupMinBaseQuality
+        self.minMapQual = 0
+        self.flagFilter = pileupSkipFlags
+        self.maxDepth = defaultMaxDepth
+    def setOption(self, o, a):
+        '''Record one of the read filter flags, returning False if o is not one of them.'''
+        if o == "--minBaseQual":
+            self.minBaseQual = safeReadInt(a)
+        elif o == "--minMapQual":
+            self.minMapQual = safeReadInt(a)
+        elif o == "--flagFilter":
+            try:
+                # decimal, or hexadecimal with 0x, as in samtools
+                self.flagFilter = int(a, 0)
+            except ValueError:
+                raise Exception, 'not a SAM flag: ' + a
+        elif o == "--maxDepth":
+            self.maxDepth = safeReadInt(a)
+        else:
+            return False
+        return True
+    def isDefault(self):
+        return self.settings() == PileupFilters().settings()
+    def settings(self):
+        return 'minBaseQual=%d,minMapQual=%d,flagFilter=%d,maxDepth=%d' % \
+            (self.minBaseQual, self.minMapQual, self.flagFilter, self.maxDepth)
+
+def columnEngineAvailable():
+    '''Can this version of pysam give the bases of a pileup column in one call?'''
+    return hasattr(getattr(pysam, 'PileupColumn', None), 'get_query_sequences')
+
+def checkColumnEngine():
+    if not columnEngineAvailable():
+        raise Exception, 'the column engine needs pysam 0.10 or later'
+
+def lookupColumn(bam, chr, col, filters, withReads=False):
+    '''The same as lookupPileup, but leaves out the reads of the filters in
+    samtools, and gives the bases of the column from one call, instead of
+    decoding the sequence of each read. Returns (pos, coverage, bases, reads):
+    the coverage counts the reads whose bases are below the least base
+    quality, as in lookupPileup, but the bases (a base for each read, in
+    upper case on the forward strand, lower case on the reverse strand and
+    '' for a deletion) and the pileup reads (only if withReads) leave them out.'''
+    columns = 0
+    column = None
+    for pileupcolumn in bam.pileup(chr, col-1, col, truncate=True,
+                                   flag_filter=filters.flagFilter, min_base_quality=filters.minBaseQual,
+                                   min_mapping_quality=filters.minMapQual, max_depth=filters.maxDepth):
+        columns += 1
+        if pileupcolumn.pos == col-1:
+            # pysam gives an empty string, not an empty list, when every
+            # read of the column is left out
+            column = (pileupcolumn.pos, pileupcolumn.n, pileupcolumn.get_query_sequences() or [],
+                      pileupcolumn.pileups if withReads else None)
+            break
+    if runStats:
+        runStats.count('pileup lookups')
+        runStats.count('pileup columns visited', columns)
+    return column
+
+def columnTallies(sites, bam, filters=None):
+    '''The same as pileupTallies, but takes the bases of each column from one
+    call (see lookupColumn), and leaves out the reads of the filters.'''
+    if filters is None:
+        filters = PileupFilters()
+    for index in xrange(len(sites)):
+        yield tallyColumnBases(lookupColumn(bam, sites.chromosome(index), sites.positions[index], filters))
+
+def tallyColumnBases(column):
+    '''Tally the bases of a column from lookupColumn, on either strand, to
+    match tallyPileupColumn.'''
+    tally = array('I', [0] * tallySize)
+    if column:
+        pos,coverage,bases,reads = column
+        if runStats:
+            runStats.count('reads inspected', len(bases))
+        for base,baseIndex in tallyBaseIndex.items():
+            tally[baseIndex] = bases.count(base) + bases.count(base.lower())
+        tally[tallyDeletions] = bases.count('')
+        tally[tallyCoverage] = coverage
+    return tally
+
+# The ways of counting the variants in a BAM file. Each one takes a VariantTable
+# of distinct sites and gives the tally (see tallyPileupColumn) of each site
+# in the table, in order. The variants are counted from the tallies by countTable.
+evidenceEngines = {
+    'pileup': pileupTallies,
+    'sweep': sweepTallies,
+    'fetch': fetchTallies,
+    'column': columnTallies,
+}
+
+# The engines which also take the PileupFilters.
+filteringEngines = ['column']
+
 def makeSafeFilename(name):
     if not os.path.exists(name):
         return name
@@ -0,0 +1,83 @@
+#!/bin/env python
+
+'''
+Compress and index a variant list.
+
+Compresses a SIFT style variant list (TSV, or CSV for
+favr_pe_bias_detector.py) with bgzip, and indexes its variants (see
+favr_variant_io.py), so that the FAVR programs only read the variants in
+the region of a run (--region). The compressed file holds the same lines
+as the variant list. VCF files are compressed and indexed with bgzip and
+tabix instead.
+
+Revision history:
+
+17 Oct 2026.   Initial version.
+'''
+
+import sys
+import getopt
+from favr_variant_io import (openText, openOutput, isCompressed, isVcf)
+
+# print a usage message
+def usage():
+    print("""Usage: %s
+    [-h | --help]
+    --variants=<variant list as TSV or CSV file>
+    --output=<compressed variant list, ending in .gz>
+    [--delimiter=<tab | comma>]""" % sys.argv[0])
+
+longOptionsFlags = ["help", "variants=", "output=", "delimiter="]
+shortOptionsFlags = "h"
+
+delimiters = { 'tab': '\t', 'comma': ',' }
+
+# A place to store command line arguments.
+class Options(object):
+    def __init__(self):
+        self.variants = None
+        self.output = None
+        self.delimiter = '\t'
+    def check(self):
+        return self.variants != None and self.output != None
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], shortOptionsFlags, longOptionsFlags)
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+    options = Options()
+    for o, a in opts:
+        if o == "--variants":
+            options.variants = a
+        elif o == "--output":
+            options.output = a
+        elif o == "--delimiter":
+            if a not in delimiters:
+                raise Exception, 'unknown delimiter, expected tab or comma: ' + a
+            options.delimiter = delimiters[a]
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+    if not options.check():
+        print('Incorrect arguments')
+        usage()
+        exit(2)
+    if isVcf(options.variants):
+        raise Exception, 'compress and index VCF files with bgzip and tabix: ' + options.variants
+    if not isCompressed(options.output):
+        raise Exception, 'the compressed variant list must end in .gz: ' + options.output
+    compressVariants(options.variants, options.output, options.delimiter)
+    print('Compressed variants saved into file: %s' % options.output)
+
+def compressVariants(variantsFilename, outputFilename, delimiter):
+    '''Copy the lines of the variant list to a compressed, indexed file.'''
+    with openText(variantsFilename) as variants:
+        with openOutput(outputFilename, 'wb', delimiter) as output:
+            for line in variants:
+                output.write(line)
+
+if __name__ == '__main__':
+    main()
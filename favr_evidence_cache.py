@@ -0,0 +1,101 @@
+'''
+On-disk cache of the evidence for variants in BAM files.
+
+Counting a variant in a BAM file gives a (sameAsVariant, coverage) pair,
+which only depends on the BAM file and the chromosome, position and base of
+the variant. The cache saves these pairs in an SQLite database, so that
+later runs (for instance with different classify arguments, or with more
+variants) only have to count the variants which are not already cached.
+
+A BAM file is identified by its absolute path, size and modification time,
+so the cached counts of a BAM file are not used once it changes. The counts
+are also keyed on the options which change how they are computed.
+
+The cache holds at most a fixed number of counts. When it grows beyond
+that, the counts which were least recently used are removed.
+'''
+
+import os
+import time
+import sqlite3
+
+# the most counts to keep in the cache, unless told otherwise
+defaultEvidenceCacheSize = 10000000
+# the most positions looked up in one query, below the limit of SQLite on
+# the number of parameters of a statement
+lookupBatchSize = 500
+
+class EvidenceCache(object):
+    def __init__(self, filename, maxEntries=defaultEvidenceCacheSize):
+        self.maxEntries = maxEntries
+        # every count looked up or stored in this run is marked as used now
+        self.now = int(time.time())
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS counts (
+            bam TEXT NOT NULL,
+            chromosome TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            base TEXT NOT NULL,
+            sameAsVariant INTEGER NOT NULL,
+            coverage INTEGER NOT NULL,
+            used INTEGER NOT NULL,
+            PRIMARY KEY (bam, chromosome, position, base))''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS countsUsed ON counts (used)')
+        self.connection.commit()
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+    def bamKey(self, bamFile, settings):
+        '''Identify a BAM file, and the settings used to count variants in it.'''
+        stat = os.stat(bamFile)
+        return '%s %d %r %s' % (os.path.abspath(bamFile), stat.st_size, stat.st_mtime, settings)
+
+    def lookup(self, bamKey, table):
+        '''Return the cached (sameAsVariant, coverage) of each variant in the
+        table, or None for the variants which are not cached. Only the
+        counts at the positions of the table are read from the cache.'''
+        positions = {}
+        for index in xrange(len(table)):
+            positions.setdefault(table.chromosome(index), set()).add(table.positions[index])
+        cached = {}
+        for chromosome, chrPositions in positions.items():
+            chrPositions = sorted(chrPositions)
+            for start in xrange(0, len(chrPositions), lookupBatchSize):
+                batch = chrPositions[start:start + lookupBatchSize]
+                for position, base, sameAsVariant, coverage in self.connection.execute(
+                        'SELECT position, base, sameAsVariant, coverage FROM counts '
+                        'WHERE bam = ? AND chromosome = ? AND position IN (%s)' % ','.join('?' * len(batch)),
+                        [bamKey, chromosome] + batch):
+                    cached[(chromosome, position, base)] = (sameAsVariant, coverage)
+        counts = []
+        used = []
+        for index in xrange(len(table)):
+            key = (table.chromosome(index), table.positions[index], table.variantBases[index])
+            count = cached.get(key)
+            counts.append(count)
+            if count != None:
+                used.append((self.now, bamKey) + key)
+        self.connection.executemany(
+            'UPDATE counts SET used = ? WHERE bam = ? AND chromosome = ? AND position = ? AND base = ?', used)
+        self.connection.commit()
+        return counts
+
+    def store(self, bamKey, table, counts):
+        '''Save the (sameAsVariant, coverage) of each variant in the table.'''
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO counts VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((bamKey, table.chromosome(index), table.positions[index], table.variantBases[index],
+              sameAsVariant, coverage, self.now)
+             for index, (sameAsVariant, coverage) in enumerate(counts)))
+        self.connection.commit()
+
+    def evict(self):
+        '''Remove the least recently used counts beyond the size of the cache.'''
+        (size,) = self.connection.execute('SELECT COUNT(*) FROM counts').fetchone()
+        if size > self.maxEntries:
+            self.connection.execute(
+                'DELETE FROM counts WHERE rowid IN (SELECT rowid FROM counts ORDER BY used LIMIT ?)',
+                (size - self.maxEntries,))
+            self.connection.commit()
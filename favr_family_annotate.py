@@ -12,7 +12,10 @@ import sys
 import csv
 import yaml
 import getopt
-from favr_common import (getEvidence, makeSafeFilename, sortByCoord, parseVariantRow)
+from favr_common import (getEvidence, makeSafeFilename, sortByCoord, parseVariantRow,
+                         EvidenceOptions, evidenceOptionsFlags, selectVariants,
+                         startStats, finishStats, statsStage, countStat)
+from favr_variant_io import (readVariantRows, openOutput)
 
 # print a usage message
 def usage():
@@ -20,14 +23,33 @@ def usage():
     [-h | --help]
     --variants=<variant list as TSV file>
     --annotations=<output TSV file with annotations added>
+    [--jobs=<number of BAM files to process in parallel>]
+    [--engine=<pileup | sweep | fetch | column>]
+    [--minBaseQual=<least base quality, column engine only>]
+    [--minMapQual=<least mapping quality, column engine only>]
+    [--flagFilter=<SAM flags of reads to leave out, column engine only>]
+    [--maxDepth=<most reads in a pileup column, column engine only>]
+    [--region=<chr:start-end>]
+    [--shard=<i/N>]
+    [--shardBy=<window | chromosome>]
+    [--evidenceCache=<cache file>]
+    [--evidenceCacheSize=<most counts to keep in the cache>]
+    [--panel=<panel directory>]
+    [--reference=<BAM file or .fai file>]
+    [--stats=<JSON statistics report file>]
+    [--prefetch=<number of variants to read ahead in each BAM file>]
+    [--adaptive]
+    [--adaptiveBlock=<number of variants counted adaptively at a time>]
+    [--adaptiveOrder=<given | hits>]
     reads1.bam reads2.bam ...""") % sys.argv[0]
 
-longOptionsFlags = ["help", "variants=", "annotations="]
+longOptionsFlags = ["help", "variants=", "annotations="] + evidenceOptionsFlags
 shortOptionsFlags = "h"
 
 # A place to store command line arguments.
-class Options(object):
+class Options(EvidenceOptions):
     def __init__(self):
+        super(Options, self).__init__()
         self.variants = None
         self.annotations = None
     def check(self):
@@ -49,15 +71,19 @@ def main():
         elif o in ('-h', '--help'):
             usage()
             sys.exit(0)
+        else:
+            options.setEvidenceOption(o, a)
     if not options.check():
         print('Incorrect arguments')
         usage()
         exit(2)
     bamFilenames = args
+    if options.stats:
+        startStats('favr_family_annotate')
     titleRow = None
     # Read the rows of the variants TSV file into a list.
-    with open(options.variants) as variants:
-        variantList = list(csv.reader(variants, delimiter='\t', quotechar='|'))
+    with statsStage('read variants'):
+        variantList = list(readVariantRows(options.variants, region=options.region))
         if len(variantList) > 0:
             # check if the first row can be parsed as a variant row
             # if this fails then we assume that the first row is a title
@@ -65,40 +91,54 @@ def main():
             if not parseVariantRow(firstRow):
                 titleRow = variantList[0]
                 variantList = variantList[1:]
+    # only keep the variants in the region and shard of this run
+    variantList = selectVariants(variantList, options)
 
     # compute the presence/absence of each variant in the bam files
-    evidence = getEvidence(variantList, bamFilenames)
+    evidence = getEvidence(variantList, bamFilenames, options, inRelative)
     # annotate the variants
-    annotate(options, titleRow, evidence)
+    with statsStage('annotate'):
+        annotate(options, titleRow, evidence)
+    countStat('variants', len(evidence))
+    finishStats(options.stats)
 
 def annotate(options, titleRow, evidence):
     '''Annotate variants which appear in a sample of a family member'''
     annotateFilename = options.annotations
-    with open(annotateFilename,'w') as annotateFile:
+    with openOutput(annotateFilename,'w','\t') as annotateFile:
         csvWriter = csv.writer(annotateFile, delimiter='\t', quotechar='|')
         if titleRow:
             csvWriter.writerow(titleRow)
-        inFamily = []
-        notInFamily = []
-        # sort the variants by coordinate
-        # XXX does this include the variant multiple times?
-#        for key,info in sortByCoord(evidence):
-#            for readCount,depth in info.counts:
-#                if readCount > 0:
-#                    inFamily.append(info.inputRow)
-#                else:
-#                    notInFamily.append(info.inputRow)
-        for key,info in sortByCoord(evidence):
-           countSum = sum([readCount for (readCount,depth) in info.counts])
-           if countSum > 0:
-              inFamily.append(info.inputRow)
-           else:
-              notInFamily.append(info.inputRow)
-        for row in inFamily:
-             csvWriter.writerow(row + ['IN RELATIVE'])
-        for row in notInFamily:
-             csvWriter.writerow(row + ['NOT IN RELATIVE'])
+        for row in annotatedRows(options, evidence):
+            csvWriter.writerow(row)
     print('Annotated reads saved into file: %s' % annotateFilename)
 
+def inRelative(counts, totalSamples):
+    '''A variant is in a relative if any of them has a read of it. With
+    --adaptive, it is not counted in the other relatives once it is.'''
+    return any(readCount > 0 for readCount,depth in counts)
+
+def annotatedRows(options, evidence):
+    '''The rows of the variants with their annotations: the variants in a
+    relative first, then the others, each sorted by coordinate.'''
+    inFamily = []
+    notInFamily = []
+    # sort the variants by coordinate
+    # XXX does this include the variant multiple times?
+#    for key,info in sortByCoord(evidence):
+#        for readCount,depth in info.counts:
+#            if readCount > 0:
+#                inFamily.append(info.inputRow)
+#            else:
+#                notInFamily.append(info.inputRow)
+    for key,info in sortByCoord(evidence, options.coordOrder):
+       countSum = sum([readCount for (readCount,depth) in info.counts])
+       if countSum > 0:
+          inFamily.append(info.inputRow)
+       else:
+          notInFamily.append(info.inputRow)
+    return [row + ['IN RELATIVE'] for row in inFamily] + \
+           [row + ['NOT IN RELATIVE'] for row in notInFamily]
+
 if __name__ == '__main__':
     main()
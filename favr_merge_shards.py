@@ -0,0 +1,147 @@
+#!/bin/env python
+
+'''
+Merge the outputs of sharded runs of the FAVR programs.
+
+Each shard of a run with --shard (or --region) writes its own keep, bin
+and log files (favr_rare_and_true_filter.py) or annotation file
+(favr_family_annotate.py). This program merges the files of one kind from
+all the shards into a single file, in the same coordinate order as an
+unsharded run.
+
+Revision history:
+
+17 Oct 2026.   Initial version.
+               Added --reference to merge outputs sorted in the chromosome
+               order of a reference.
+               Read and write bgzip compressed files, when their names end
+               in .gz.
+'''
+
+import sys
+import csv
+import getopt
+import heapq
+from favr_common import (parseVariantRow, defaultCoordOrder, CoordOrder, readReferenceChromosomes)
+from favr_variant_io import (readVariantRows, openText, openOutput)
+
+# print a usage message
+def usage():
+    print("""Usage: %s
+    [-h | --help]
+    --type=<keep | bin | log | annotations>
+    --output=<merged output file>
+    [--reference=<BAM file or .fai file>]
+    shard1 shard2 ...""" % sys.argv[0])
+
+longOptionsFlags = ["help", "type=", "output=", "reference="]
+shortOptionsFlags = "h"
+
+# A place to store command line arguments.
+class Options(object):
+    def __init__(self):
+        self.type = None
+        self.output = None
+        self.coordOrder = defaultCoordOrder
+    def check(self):
+        return self.type in mergers and self.output != None
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], shortOptionsFlags, longOptionsFlags)
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+    options = Options()
+    for o, a in opts:
+        if o == "--type":
+            options.type = a
+        elif o == "--output":
+            options.output = a
+        elif o == "--reference":
+            options.coordOrder = CoordOrder(readReferenceChromosomes(a))
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+    if not options.check():
+        print('Incorrect arguments')
+        usage()
+        exit(2)
+    shardFilenames = args
+    mergers[options.type](shardFilenames, options.output, options.coordOrder)
+
+def mergeSorted(shards, order):
+    '''Merge lists of (id, item) pairs, each sorted by coordinate, into one
+    list of items sorted by coordinate. A shard never has the same
+    coordinates as another shard, so the order of the shards does not matter.'''
+    keyed = [[(order.idKey(id), item) for id, item in shard] for shard in shards]
+    return [item for key, item in heapq.merge(*keyed)]
+
+def readRows(filename):
+    return list(readVariantRows(filename))
+
+def mergeKeep(shardFilenames, outputFilename, order):
+    shards = [[(parseVariantRow(row).id, row) for row in readRows(filename)]
+              for filename in shardFilenames]
+    with openOutput(outputFilename, 'wb', '\t') as output:
+        csvWriter = csv.writer(output, delimiter='\t', quotechar='|')
+        for row in mergeSorted(shards, order):
+            csvWriter.writerow(row)
+
+def readBinGroups(filename):
+    '''Read the groups of lines in a bin file, each one starting with the
+    coordinate of the variant, followed by indented lines of counts.'''
+    groups = []
+    with openText(filename) as file:
+        for line in file:
+            if line.startswith(' '):
+                groups[-1][1].append(line)
+            else:
+                groups.append((line.rstrip('\n'), [line]))
+    return groups
+
+def mergeBin(shardFilenames, outputFilename, order):
+    shards = [readBinGroups(filename) for filename in shardFilenames]
+    with openOutput(outputFilename, 'w') as output:
+        for lines in mergeSorted(shards, order):
+            output.writelines(lines)
+
+def mergeLog(shardFilenames, outputFilename, order):
+    shards = []
+    for filename in shardFilenames:
+        with openText(filename) as file:
+            # each line starts with the coordinate of the variant: "chrN:pos: "
+            shards.append([(line.split(': ', 1)[0], line) for line in file])
+    with openOutput(outputFilename, 'w') as output:
+        output.writelines(mergeSorted(shards, order))
+
+def mergeAnnotations(shardFilenames, outputFilename, order):
+    '''The variants in relatives come before the variants not in relatives,
+    each group sorted by coordinate, after the title row (if any).'''
+    titleRow = None
+    inFamily = []
+    notInFamily = []
+    for filename in shardFilenames:
+        rows = readRows(filename)
+        if rows and not parseVariantRow(rows[0]):
+            titleRow = rows[0]
+            rows = rows[1:]
+        inFamily.append([(parseVariantRow(row).id, row) for row in rows if row[-1] == 'IN RELATIVE'])
+        notInFamily.append([(parseVariantRow(row).id, row) for row in rows if row[-1] == 'NOT IN RELATIVE'])
+    with openOutput(outputFilename, 'w', '\t') as output:
+        csvWriter = csv.writer(output, delimiter='\t', quotechar='|')
+        if titleRow:
+            csvWriter.writerow(titleRow)
+        for row in mergeSorted(inFamily, order) + mergeSorted(notInFamily, order):
+            csvWriter.writerow(row)
+
+mergers = {
+    'keep': mergeKeep,
+    'bin': mergeBin,
+    'log': mergeLog,
+    'annotations': mergeAnnotations,
+}
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/bin/env python
+
+'''
+Build a panel of comparators for favr_rare_and_true_filter.py.
+
+Counts the reads with each base at every candidate variant site in each
+comparator BAM file once, and saves the counts in a panel directory (see
+favr_panel_store.py). The filter can then look up the evidence for
+variants at those sites in the panel (with --panel), instead of reading
+all of the comparator BAM files for every sample.
+
+The sites of a panel are fixed when it is created: they are the union of
+the sites of the variant lists given with --sites. Running the program on
+an existing panel adds the BAM files which are not already in it as new
+comparators, without counting the others again.
+
+Revision history:
+
+17 Oct 2026.   Initial version.
+               Record the evidence engine of the panel.
+'''
+
+import os
+import sys
+import getopt
+import multiprocessing
+import pysam
+from array import array
+from favr_common import (safeReadInt, parseVariantRow, tallyPositions)
+from favr_panel_store import (PanelSites, readPanelSites, readPanelSamples, appendPanelSample,
+                              writePanelEngine)
+from favr_variant_io import readVariantRows
+
+# print a usage message
+def usage():
+    print("""Usage: %s
+    [-h | --help]
+    --panel=<panel directory>
+    [--sites=<variant list as TSV file>] ...
+    [--jobs=<number of BAM files to process in parallel>]
+    comparator1.bam comparator2.bam ...""" % sys.argv[0])
+
+longOptionsFlags = ["help", "panel=", "sites=", "jobs="]
+shortOptionsFlags = "h"
+
+# A place to store command line arguments.
+class Options(object):
+    def __init__(self):
+        self.panel = None
+        self.sites = []
+        self.jobs = 1
+    def check(self):
+        return self.panel != None
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], shortOptionsFlags, longOptionsFlags)
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+    options = Options()
+    for o, a in opts:
+        if o == "--panel":
+            options.panel = a
+        elif o == "--sites":
+            options.sites.append(a)
+        elif o == "--jobs":
+            options.jobs = safeReadInt(a)
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+    if not options.check():
+        print('Incorrect arguments')
+        usage()
+        exit(2)
+    bamFilenames = args
+    sitesFilename = os.path.join(options.panel, 'sites')
+    if os.path.exists(sitesFilename):
+        if options.sites:
+            raise Exception, 'the sites of an existing panel can not be changed: ' + options.panel
+        sites = readPanelSites(sitesFilename)
+    else:
+        if not options.sites:
+            raise Exception, 'a new panel needs at least one --sites variant list'
+        if not os.path.isdir(options.panel):
+            os.makedirs(options.panel)
+        sites = unionOfSites(options.sites)
+        sites.write(sitesFilename)
+        # the sites are tallied by walking the pileup, as the sweep engine does
+        writePanelEngine(options.panel, 'sweep')
+    existing = set(bamFile for column,bamFile in readPanelSamples(options.panel))
+    newBamFilenames = []
+    for bamFile in bamFilenames:
+        if bamFile in existing:
+            print('Already in the panel: %s' % bamFile)
+        else:
+            newBamFilenames.append(bamFile)
+    for bamFile,counts in zip(newBamFilenames, tallyBamFiles(newBamFilenames, sites, options)):
+        appendPanelSample(options.panel, bamFile, counts)
+        print('Added to the panel: %s' % bamFile)
+
+def unionOfSites(variantFilenames):
+    '''The sorted positions of every variant in the variant lists.'''
+    positions = {}
+    for filename in variantFilenames:
+        for row in readVariantRows(filename):
+            info = parseVariantRow(row)
+            # skip title rows and invalid rows
+            if info:
+                positions.setdefault(info.chromosome, set()).add(info.position)
+    sites = PanelSites()
+    for chr in sorted(positions):
+        sites.add(chr, positions[chr])
+    return sites
+
+def tallyBamFiles(bamFilenames, sites, options):
+    '''Yield the tallies of every site in each BAM file, in order.'''
+    if options.jobs > 1 and len(bamFilenames) > 1:
+        pool = multiprocessing.Pool(processes = min(options.jobs, len(bamFilenames)),
+                                    initializer = initPanelWorker, initargs = (sites,))
+        try:
+            # imap yields the results in the order of the BAM files, so the
+            # columns of the panel are in the same order as a serial run
+            for counts in pool.imap(tallyBamFile, bamFilenames):
+                yield counts
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        initPanelWorker(sites)
+        for bamFile in bamFilenames:
+            yield tallyBamFile(bamFile)
+
+# The sites of the panel for the current worker process, set once when the worker starts.
+workerSites = None
+
+def initPanelWorker(sites):
+    global workerSites
+    workerSites = sites
+
+def tallyBamFile(bamFile):
+    '''Tally every site of the panel in one BAM file, returning the tallies
+    one after the other in a flat array.'''
+    counts = array('I')
+    with pysam.Samfile(bamFile, "rb") as bam:
+        for chr in workerSites.chromosomes:
+            for tally in tallyPositions(bam, chr, workerSites.positions[chr]):
+                counts.extend(tally)
+    return counts
+
+if __name__ == '__main__':
+    main()
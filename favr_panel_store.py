@@ -0,0 +1,171 @@
+'''
+A precomputed store of the base counts of a panel of comparator samples.
+
+The panel is a directory. It holds a fixed, sorted set of sites (the union
+of the candidate variant sites it was built for) and, for each comparator
+sample (BAM file), one column file with six counts for every site:
+
+    A, C, G, T, deletions, coverage
+
+which is the tally of the pileup column of the sample at the site. The
+evidence for any variant at one of the sites can be read from the column
+files, without reading the BAM files again. Adding a comparator to the
+panel only writes one more column file.
+
+The files of a panel are:
+
+    sites        the sites: for each chromosome a line with its name and
+                 number of sites, followed by its sorted positions in binary
+    samples      one line per comparator: its column file name and BAM file
+    engine       the evidence engine which counted the comparators
+    column<N>    the counts of comparator N, in the same order as the sites
+
+The column files are memory-mapped when they are read, so only the parts
+for the variants being looked up are read from disk.
+
+The panel is built by favr_panel_build.py.
+'''
+
+import os
+import sys
+import mmap
+import bisect
+from array import array
+
+# the number of counts per site in a column file, and where the deletions
+# and coverage are
+tallySize = 6
+tallyDeletions = 4
+tallyCoverage = 5
+# the position of each base in the counts of a site
+tallyBaseIndex = { 'A': 0, 'C': 1, 'G': 2, 'T': 3 }
+
+# The engine of the panels which have no engine file, which were all
+# counted by walking the pileup of each cluster of sites.
+defaultPanelEngine = 'sweep'
+
+# The first line of the sites file. The format of the binary parts of the
+# panel depends on the byte order and size of the array items.
+panelMagic = 'FAVR panel 1 %s %d %d\n' % (sys.byteorder, array('i').itemsize, array('I').itemsize)
+
+class PanelSites(object):
+    '''The sorted positions of the sites of a panel, for each chromosome.'''
+    def __init__(self):
+        self.chromosomes = [] # chromosome names, in the order of the sites
+        self.positions = {}   # chromosome -> array of sorted positions
+        self.offsets = {}     # chromosome -> index of its first site
+
+    def add(self, chr, positions):
+        self.offsets[chr] = len(self)
+        self.chromosomes.append(chr)
+        self.positions[chr] = array('i', sorted(set(positions)))
+
+    def __len__(self):
+        return sum(len(positions) for positions in self.positions.values())
+
+    def siteIndex(self, chr, position):
+        '''The index of a site, or None if it is not one of the sites.'''
+        positions = self.positions.get(chr)
+        if positions != None:
+            index = bisect.bisect_left(positions, position)
+            if index < len(positions) and positions[index] == position:
+                return self.offsets[chr] + index
+        return None
+
+    def write(self, filename):
+        with open(filename, 'wb') as sites:
+            sites.write(panelMagic)
+            for chr in self.chromosomes:
+                sites.write('%s\t%d\n' % (chr, len(self.positions[chr])))
+                self.positions[chr].tofile(sites)
+
+def readPanelSites(filename):
+    sites = PanelSites()
+    with open(filename, 'rb') as sitesFile:
+        if sitesFile.readline() != panelMagic:
+            raise Exception, 'not a panel sites file, or made on a different kind of computer: ' + filename
+        # read the chromosome lines with readline, because iterating over
+        # the file would read ahead past the positions
+        line = sitesFile.readline()
+        while line:
+            chr, size = line.rstrip('\n').split('\t')
+            positions = array('i')
+            positions.fromfile(sitesFile, int(size))
+            sites.offsets[chr] = len(sites)
+            sites.chromosomes.append(chr)
+            sites.positions[chr] = positions
+            line = sitesFile.readline()
+    return sites
+
+def readPanelSamples(directory):
+    '''The (column file name, BAM file name) of each comparator in the panel, in order.'''
+    samples = []
+    filename = os.path.join(directory, 'samples')
+    if os.path.exists(filename):
+        with open(filename) as samplesFile:
+            for line in samplesFile:
+                column, bamFile = line.rstrip('\n').split('\t', 1)
+                samples.append((column, bamFile))
+    return samples
+
+def readPanelEngine(directory):
+    '''The evidence engine which counted the comparators of the panel.'''
+    filename = os.path.join(directory, 'engine')
+    if os.path.exists(filename):
+        with open(filename) as engineFile:
+            return engineFile.read().strip()
+    return defaultPanelEngine
+
+def writePanelEngine(directory, engine):
+    with open(os.path.join(directory, 'engine'), 'w') as engineFile:
+        engineFile.write(engine + '\n')
+
+def appendPanelSample(directory, bamFile, counts):
+    '''Add a comparator to the panel, given an array of the tallies of all
+    of the sites, one after the other, in order.'''
+    column = 'column%d' % len(readPanelSamples(directory))
+    with open(os.path.join(directory, column), 'wb') as columnFile:
+        counts.tofile(columnFile)
+    # the sample is only added to the panel once its column is complete
+    with open(os.path.join(directory, 'samples'), 'a') as samplesFile:
+        samplesFile.write('%s\t%s\n' % (column, bamFile))
+
+class Panel(object):
+    '''A panel of comparators, opened for looking up the evidence of variants.'''
+    def __init__(self, directory):
+        self.directory = directory
+        self.sites = readPanelSites(os.path.join(directory, 'sites'))
+        self.samples = readPanelSamples(directory)
+        self.engine = readPanelEngine(directory)
+
+    def bamFilenames(self):
+        return [bamFile for column, bamFile in self.samples]
+
+    def tallies(self, column, siteIndices):
+        '''Yield the tally of each of the sites in one column file.'''
+        itemSize = array('I').itemsize
+        with open(os.path.join(self.directory, column), 'rb') as columnFile:
+            # an empty file can not be memory mapped
+            if len(self.sites) == 0:
+                return
+            counts = mmap.mmap(columnFile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for siteIndex in siteIndices:
+                    start = siteIndex * tallySize * itemSize
+                    yield array('I', counts[start:start + tallySize * itemSize])
+            finally:
+                counts.close()
+
+    def counts(self, table):
+        '''Yield the (sameAsVariant, coverage) of every variant in the table, for
+        each comparator in the panel, in the same form as countBamFiles.'''
+        siteIndices = []
+        for index in xrange(len(table)):
+            siteIndex = self.sites.siteIndex(table.chromosome(index), table.positions[index])
+            if siteIndex == None:
+                raise Exception, 'variant %s is not one of the sites of the panel %s' % \
+                    (table.ids[index], self.directory)
+            siteIndices.append(siteIndex)
+        for column, bamFile in self.samples:
+            yield [(tally[tallyBaseIndex[table.variantBases[index]]], tally[tallyCoverage])
+                   for index, tally in enumerate(self.tallies(column, siteIndices))]
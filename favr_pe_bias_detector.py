@@ -8,14 +8,35 @@ Authors: Bernie Pope, Danny Park, Tu Nguyen-Dumont.
 Revision history:
 
 29 Aug 2011.   Initial version.
+
+17 Oct 2026.   Added --jobs to count the variants of different chromosomes
+               in parallel.
+               Find the size of each read from the number of bases in it,
+               instead of summing its CIGAR. Added --readSize=cigar to use
+               the CIGAR as before.
+               Added --stats to save the time taken and counters of the
+               work done in a JSON report.
+               Added --prefetch to read ahead in the bam file while
+               counting, for slow (network) file systems.
+               Added --engine=column to take the bases of each pileup
+               column in one call, and the read filters --minBaseQual,
+               --minMapQual, --flagFilter and --maxDepth.
+               Read VCF files and bgzip compressed variant lists, and write
+               bgzip compressed outputs when their names end in .gz.
 '''
 
 import os
 import pysam
 import sys
-import csv
 import getopt
-from favr_common import (parsePolymorphism, lookupPileup, makeSafeFilename)
+import multiprocessing
+from contextlib import contextmanager
+from favr_common import (safeReadInt, parsePolymorphism, lookupPileup, makeSafeFilename,
+                         startStats, finishStats, statsStage, countStat, recordingStats,
+                         addWorkerCounters, workerStats, takeWorkerCounters,
+                         PileupFilters, checkColumnEngine, lookupColumn, pileupQueryPosition)
+from favr_prefetch import (Prefetcher, prefetching, canPrefetch)
+from favr_variant_io import (readVariantRows, openOutput)
 
 # print a usage message
 def usage():
@@ -25,9 +46,19 @@ def usage():
     --bam=<bam file of reads for the same sample as variants>
     --bin=<bin filename>
     --keep=<keep filename>
-    --log=<log filename>""" % sys.argv[0])
+    --log=<log filename>
+    [--jobs=<number of worker processes>]
+    [--readSize=<query | cigar>]
+    [--stats=<JSON statistics report file>]
+    [--prefetch=<number of variants to read ahead in the bam file>]
+    [--engine=<pileup | column>]
+    [--minBaseQual=<least base quality, column engine only>]
+    [--minMapQual=<least mapping quality, column engine only>]
+    [--flagFilter=<SAM flags of reads to leave out, column engine only>]
+    [--maxDepth=<most reads in a pileup column, column engine only>]""" % sys.argv[0])
 
-longOptionsFlags = ["help", "variants=", "bam=", "bin=", "keep=", "log="]
+longOptionsFlags = ["help", "variants=", "bam=", "bin=", "keep=", "log=", "jobs=", "readSize=", "stats=",
+                    "prefetch=", "engine=", "minBaseQual=", "minMapQual=", "flagFilter=", "maxDepth="]
 shortOptionsFlags = "h"
 
 class Options(object):
@@ -37,8 +68,18 @@ class Options(object):
         self.keep = None
         self.log = None
         self.bam = None
+        self.jobs = 1
+        self.readSize = 'query'
+        self.stats = None
+        self.prefetch = 0
+        self.engine = 'pileup'
+        self.filters = PileupFilters()
     def check(self):
-        return all([self.variants, self.bam, self.bin, self.keep, self.log])
+        return all([self.variants, self.bam, self.bin, self.keep, self.log]) and \
+            (self.engine == 'column' or self.filters.isDefault())
+    def columnFilters(self):
+        '''The read filters of the column engine, or None for the pileup engine.'''
+        return self.filters if self.engine == 'column' else None
 
 def main():
     try:
@@ -59,70 +100,261 @@ def main():
             options.keep = a
         elif o == "--log":
             options.log = a
+        elif o == "--jobs":
+            options.jobs = safeReadInt(a)
+        elif o == "--readSize":
+            if a not in readSizes:
+                raise Exception, 'unknown readSize, expected query or cigar: ' + a
+            options.readSize = a
+        elif o == "--stats":
+            options.stats = a
+        elif o == "--prefetch":
+            options.prefetch = safeReadInt(a)
+        elif o == "--engine":
+            if a not in ['pileup', 'column']:
+                raise Exception, 'unknown engine, expected pileup or column: ' + a
+            if a == 'column':
+                checkColumnEngine()
+            options.engine = a
         elif o in ('-h', '--help'):
             usage()
             sys.exit(0)
+        else:
+            options.filters.setOption(o, a)
     if not options.check():
         print('Incorrect arguments')
         usage()
         exit(2)
-    filterVariants(options)
+    if options.stats:
+        startStats('favr_pe_bias_detector')
+    with statsStage('filter variants'):
+        filterVariants(options)
+    finishStats(options.stats)
 
 def filterVariants(options):
-    variantFile = open(options.variants)
+    if options.jobs > 1:
+        filterVariantsParallel(options)
+        return
     with pysam.Samfile(options.bam, "rb") as bam:
-        with open(options.bin, 'w') as binFile:
-            with open(options.keep,'wb') as keepFile:
-                with open(options.log, 'wb') as logFile:
-                    for variant in csv.reader(variantFile, delimiter=',', quotechar='|'):
-                        variantStr = ','.join(variant)
-                        thirty_fives,fifties = count_read_sizes(variant, bam)
-                        logFile.write('%s: 35s=%d, 50s=%d' % (variantStr, thirty_fives, fifties))
-                        if thirty_fives > 0 and fifties == 0:
-                            binFile.write('%s\n' % variantStr)
-                            logFile.write(', bin\n')
-                        else:
-                            keepFile.write('%s\n' % variantStr)
-                            logFile.write(', keep\n')
-    variantFile.close()
-
-def count_read_sizes(variant, bamFile):
+        with openOutputs(options) as outputs:
+            variants = readVariantRows(options.variants, delimiter=',')
+            for variant in prefetchVariants(variants, bam, options.bam, options.prefetch):
+                thirty_fives,fifties = count_read_sizes(variant, bam, readSize=options.readSize,
+                                                        filters=options.columnFilters())
+                writeVariant(outputs, variant, thirty_fives, fifties)
+
+@contextmanager
+def openOutputs(options):
+    '''Open the bin, keep and log files, bgzip compressed if their names end
+    in .gz, with the variants of the bin and keep files indexed.'''
+    with openOutput(options.bin, 'w', ',') as binFile:
+        with openOutput(options.keep,'wb', ',') as keepFile:
+            with openOutput(options.log, 'wb') as logFile:
+                yield binFile, keepFile, logFile
+
+def writeVariant(outputs, variant, thirty_fives, fifties):
+    '''Bin or keep a variant, given the number of 35 and 50 base reads it is on.'''
+    binFile, keepFile, logFile = outputs
+    variantStr = ','.join(variant)
+    logFile.write('%s: 35s=%d, 50s=%d' % (variantStr, thirty_fives, fifties))
+    if isPeBiased(thirty_fives, fifties):
+        binFile.write('%s\n' % variantStr)
+        logFile.write(', bin\n')
+    else:
+        keepFile.write('%s\n' % variantStr)
+        logFile.write(', keep\n')
+
+def isPeBiased(thirty_fives, fifties):
+    '''Should a variant be binned, because it is only on 35 base reads?'''
+    return thirty_fives > 0 and fifties == 0
+
+# The most variants of one chromosome counted by a worker in one task. The
+# variants of a large chromosome are split into several tasks, so that the
+# work is spread evenly over the workers.
+parallelTaskSize = 1000
+
+def filterVariantsParallel(options):
+    '''The same as filterVariants, but counts the variants in a pool of worker
+    processes, each with its own handle on the bam file. The variants are
+    grouped by chromosome, so each worker reads one part of the bam file at
+    a time. The results are written in the order of the input, as soon as
+    all of the variants before them are done, so the output is the same as
+    a serial run.'''
+    variants = list(readVariantRows(options.variants, delimiter=','))
+    pool = multiprocessing.Pool(processes = options.jobs,
+                                initializer = initPeBiasWorker,
+                                initargs = (options.bam, options.readSize, options.prefetch,
+                                            options.columnFilters(), recordingStats()))
+    try:
+        with openOutputs(options) as outputs:
+            # results of variants which are done, waiting for earlier ones
+            pending = {}
+            nextIndex = 0
+            for results,counters in pool.imap_unordered(countTask, chromosomeTasks(variants)):
+                addWorkerCounters(counters)
+                for index,thirty_fives,fifties,warnings in results:
+                    pending[index] = (thirty_fives, fifties, warnings)
+                while nextIndex in pending:
+                    thirty_fives,fifties,warnings = pending.pop(nextIndex)
+                    for warning in warnings:
+                        print(warning)
+                    writeVariant(outputs, variants[nextIndex], thirty_fives, fifties)
+                    nextIndex += 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def chromosomeTasks(variants):
+    '''Split the (index, variant) pairs into tasks of at most parallelTaskSize
+    variants on the same chromosome. Rows which are not valid variants have
+    no chromosome, and are grouped together.'''
+    byChromosome = {}
+    chromosomes = []
+    for index,variant in enumerate(variants):
+        info = parseVariantRow(variant)
+        chr = info.chromosome if info else None
+        if chr not in byChromosome:
+            byChromosome[chr] = []
+            chromosomes.append(chr)
+        byChromosome[chr].append((index, variant))
+    for chr in chromosomes:
+        group = byChromosome[chr]
+        for start in xrange(0, len(group), parallelTaskSize):
+            yield group[start:start+parallelTaskSize]
+
+# The bam file of the current worker process, opened once when the worker
+# starts, how it finds the size of each read, how far it reads ahead, and the
+# read filters of the column engine (None for the pileup engine).
+workerBamFilename = None
+workerBam = None
+workerReadSize = None
+workerPrefetch = 0
+workerFilters = None
+
+def initPeBiasWorker(bamFilename, readSize, prefetch=0, filters=None, recordStats=False):
+    global workerBamFilename, workerBam, workerReadSize, workerPrefetch, workerFilters
+    workerBamFilename = bamFilename
+    workerBam = pysam.Samfile(bamFilename, "rb")
+    workerReadSize = readSize
+    workerPrefetch = prefetch
+    workerFilters = filters
+    workerStats(recordStats)
+
+def countTask(task):
+    '''Count the read sizes of each (index, variant) in the task, giving back
+    the counts and the warnings for each one, to be printed in input order,
+    and the statistics counters of the worker.'''
+    results = []
+    variants = prefetchVariants([variant for index,variant in task], workerBam, workerBamFilename, workerPrefetch)
+    for n,variant in enumerate(variants):
+        index = task[n][0]
+        warnings = []
+        thirty_fives,fifties = count_read_sizes(variant, workerBam, warnings, workerReadSize, workerFilters)
+        results.append((index, thirty_fives, fifties, warnings))
+    return results, takeWorkerCounters()
+
+def prefetchVariants(variants, bam, bamFilename, prefetch):
+    '''Yield the variants in turn, reading the parts of the bam file which
+    cover up to prefetch variants ahead in background threads.'''
+    if prefetch <= 0 or not canPrefetch(bamFilename):
+        return variants
+    variants = list(variants)
+    regions = []
+    for variant in variants:
+        info = parseVariantRow(variant)
+        regions.append((info.chromosome, info.position - 1, info.position) if info else None)
+    return prefetching(variants, Prefetcher(bamFilename, bam.references, regions, prefetch))
+
+def count_read_sizes(variant, bamFile, warnings=None, readSize='query', filters=None):
+    '''Count the 35 and 50 base reads with the variant base, finding the size
+    of each read with one of the readSizes. The warnings are printed, or
+    added to the warnings list if one is given. With read filters, the
+    bases are taken from the pileup column in one call (see lookupColumn),
+    and only the reads with the variant base are looked at.'''
+    def warn(message):
+        if warnings is None:
+            print(message)
+        else:
+            warnings.append(message)
     thirty_fives = 0 # number of variants on 35 read in pair
     fifties = 0 # number of variants on 50 read in pair
     info = parseVariantRow(variant)
+    countStat('variants')
     # only process valid rows in the variant TSV file
     if info:
-        # get the pileup information for this particular variant coordinates
-        # the pileup tells us what base was called in each of the reads at
-        # this particular coordinate
-        pileupCol = lookupPileup(bamFile, info.chromosome, info.position)
-        if pileupCol:
-            #reads = pileupCol
-            pos,coverage,reads = pileupCol
-            # Count the number of reads that are the same as the variant
-            for pileupread in reads:
-                # find the base at the same position as the variant
-                readBase = pileupread.alignment.seq[pileupread.qpos]
-                if not pileupread.is_del and readBase == info.variantBase:
-                    # get the size of the read for the base using the cigar of the read
-                    cigar = pileupread.alignment.cigar
-                    if cigar:
-                        read_size = 0
-                        for code,length in cigar:
-                            read_size += length
-                        # count the number of 35, 50 and unknown length reads
-                        if read_size >= 20 and read_size <= 35:
-                            thirty_fives += 1
-                        elif read_size >= 40 and read_size <= 50:
-                            fifties += 1
-                    # we couldn't figure out the size from the cigar
-                    # skip and print a warning
-                    else:
-                        print('Warning: could not find cigar info for variant: %s, skipping' % str(variant))
+        if filters:
+            supporting = columnSupportingReads(bamFile, info, filters)
+        else:
+            supporting = pileupSupportingReads(bamFile, info)
+        if supporting != None:
+            for read in supporting:
+                read_size = readSizes[readSize](read)
+                if read_size != None:
+                    # count the number of 35, 50 and unknown length reads
+                    if read_size >= 20 and read_size <= 35:
+                        thirty_fives += 1
+                    elif read_size >= 40 and read_size <= 50:
+                        fifties += 1
+                # we couldn't figure out the size of the read
+                # skip and print a warning
+                else:
+                    warn('Warning: could not find %s info for variant: %s, skipping' % (readSize, str(variant)))
         else:
-            print('Warning: could not find pileup for variant: %s' % str(variant))
+            warn('Warning: could not find pileup for variant: %s' % str(variant))
     return thirty_fives, fifties
 
+def pileupSupportingReads(bamFile, info):
+    '''The reads with the variant base at the variant position, or None if
+    there is no pileup there.'''
+    # get the pileup information for this particular variant coordinates
+    # the pileup tells us what base was called in each of the reads at
+    # this particular coordinate
+    pileupCol = lookupPileup(bamFile, info.chromosome, info.position)
+    if not pileupCol:
+        return None
+    pos,coverage,reads = pileupCol
+    countStat('reads inspected', len(reads))
+    # find the base at the same position as the variant in each read
+    return [pileupread.alignment for pileupread in reads
+            if not pileupread.is_del and pileupread.alignment.seq[pileupQueryPosition(pileupread)] == info.variantBase]
+
+def columnSupportingReads(bamFile, info, filters):
+    '''The same as pileupSupportingReads, but takes the bases from the pileup
+    column in one call (see lookupColumn) and leaves out the reads of the
+    filters. Only the reads with the variant base are looked at.'''
+    column = lookupColumn(bamFile, info.chromosome, info.position, filters, withReads=True)
+    if not column:
+        return None
+    pos,coverage,bases,reads = column
+    countStat('reads inspected', len(bases))
+    return [pileupread.alignment for base,pileupread in zip(bases, reads)
+            if base.upper() == info.variantBase]
+
+def queryReadSize(read):
+    '''The number of bases sequenced in the read, or None if it is not known.'''
+    return read.rlen or None
+
+def cigarReadSize(read):
+    '''The sum of the lengths of the CIGAR operations of the read, or None if
+    it has no CIGAR. Deletions, skips and hard clips are counted too, so this
+    is larger than the number of bases sequenced for reads which have them.'''
+    cigar = read.cigar
+    if cigar:
+        read_size = 0
+        for code,length in cigar:
+            read_size += length
+        return read_size
+    return None
+
+# The ways of finding the size of a read.
+readSizes = {
+    'query': queryReadSize,
+    'cigar': cigarReadSize,
+}
+
 class VariantInfo(object):
     '''Interesting information about a particular variant.'''
     def __init__(self, id, chromosome, position, refBase, variantBase, inputRow):
@@ -0,0 +1,305 @@
+#!/bin/env python
+
+'''
+Run the FAVR programs as one pipeline.
+
+Runs the stages of the usual FAVR workflow on one variant list:
+
+    1. favr_pe_bias_detector.py on the bam file of the sample
+    2. favr_rare_and_true_filter.py on the bam files of the comparators
+    3. favr_family_annotate.py on the bam files of the relatives
+    4. favr_refgene_annotate.py on a refGene file
+
+The variant list is read once, and each stage is given the variants kept
+by the stage before it in memory, instead of through intermediate files.
+Bam files which are both comparators and relatives are only read once: the
+counts of the variants from the filter stage are used again in the family
+stage. The outputs of each stage can still be saved as side outputs, in
+the same format as the program of the stage.
+
+A stage is only run if its inputs are given: --sample for the first
+stage, --comparator for the second, --relative for the third and
+--refGene for the fourth.
+
+Revision history:
+
+17 Oct 2026.   Initial version.
+               Added --prefetch to read ahead in the bam files while
+               counting, for slow (network) file systems.
+               Added --engine=column and its read filters, which are also
+               used to find the read sizes in the pe bias stage.
+               Read VCF files and bgzip compressed variant lists, and write
+               bgzip compressed outputs when their names end in .gz.
+               With --stats, count the variants of each stage separately.
+'''
+
+import os
+import sys
+import csv
+import getopt
+import pysam
+from itertools import izip
+from contextlib import contextmanager
+from favr_common import (safeReadInt, EvidenceOptions, VariantTable, initEvidence, addCounts,
+                         countBamFiles, parseVariantRow, startStats, finishStats, statsStage,
+                         countStat, renameStat)
+from favr_pe_bias_detector import (count_read_sizes, writeVariant, isPeBiased, readSizes, prefetchVariants)
+from favr_rare_and_true_filter import writeClassifications
+from favr_family_annotate import annotatedRows
+from favr_refgene_annotate import (loadRefGene, annotateRows)
+from favr_variant_io import (readVariantRows, openOutput)
+
+# print a usage message
+def usage():
+    print("""Usage: %s
+    [-h | --help]
+    --variants=<variant list as TSV file>
+    --output=<output TSV file>
+    [--sample=<bam file of reads for the same sample as variants>]
+    [--readSize=<query | cigar>]
+    [--comparator=<comparator bam file>] ...
+    [--varLikeThresh=<variant read threshold>]
+    [--samplesPercent=<percent of total samples which pass the threshold>]
+    [--relative=<relative bam file>] ...
+    [--refGene=<refGene.txt file>]
+    [--startslack=<distance from start of coding region>]
+    [--spliceslack=<distance from exon start/end sites>]
+    [--nocache]
+    [--peBin=<bin filename>]
+    [--peKeep=<keep filename>]
+    [--peLog=<log filename>]
+    [--bin=<bin filename>]
+    [--keep=<keep filename>]
+    [--log=<log filename>]
+    [--annotations=<family annotations filename>]
+    [--jobs=<number of BAM files to process in parallel>]
+    [--engine=<pileup | sweep | fetch | column>]
+    [--minBaseQual=<least base quality, column engine only>]
+    [--minMapQual=<least mapping quality, column engine only>]
+    [--flagFilter=<SAM flags of reads to leave out, column engine only>]
+    [--maxDepth=<most reads in a pileup column, column engine only>]
+    [--reference=<BAM file or .fai file>]
+    [--stats=<JSON statistics report file>]
+    [--prefetch=<number of variants to read ahead in each BAM file>]""" % sys.argv[0])
+
+# the evidence options which apply to the pipeline
+pipelineEvidenceFlags = ["jobs=", "engine=", "reference=", "stats=", "prefetch=",
+                         "minBaseQual=", "minMapQual=", "flagFilter=", "maxDepth="]
+
+longOptionsFlags = ["help", "variants=", "output=", "sample=", "readSize=", "comparator=", "varLikeThresh=",
+                    "samplesPercent=", "relative=", "refGene=", "startslack=", "spliceslack=", "nocache",
+                    "peBin=", "peKeep=", "peLog=", "bin=", "keep=", "log=", "annotations="] + \
+                   pipelineEvidenceFlags
+shortOptionsFlags = "h"
+
+# A place to store command line arguments.
+class Options(EvidenceOptions):
+    def __init__(self):
+        super(Options, self).__init__()
+        self.variants = None
+        self.output = None
+        self.sample = None
+        self.readSize = 'query'
+        self.comparators = []
+        self.varLikeThresh = None
+        self.samplesPercent = None
+        self.relatives = []
+        self.refGene = None
+        self.startslack = None
+        self.spliceslack = None
+        self.cache = True
+        # side outputs, not saved unless they are given
+        self.peBin = None
+        self.peKeep = None
+        self.peLog = None
+        self.bin = None
+        self.keep = None
+        self.log = None
+        self.annotations = None
+    def check(self):
+        return (self.variants != None and self.output != None and
+                (not self.comparators or (self.varLikeThresh != None and self.samplesPercent != None)) and
+                (self.refGene == None or (self.startslack != None and self.spliceslack != None)) and
+                (self.engine == 'column' or self.filters.isDefault()))
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], shortOptionsFlags, longOptionsFlags)
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+    options = Options()
+    for o, a in opts:
+        if o == "--variants":
+            options.variants = a
+        elif o == "--output":
+            options.output = a
+        elif o == "--sample":
+            options.sample = a
+        elif o == "--readSize":
+            if a not in readSizes:
+                raise Exception, 'unknown readSize, expected query or cigar: ' + a
+            options.readSize = a
+        elif o == "--comparator":
+            options.comparators.append(a)
+        elif o == "--varLikeThresh":
+            options.varLikeThresh = safeReadInt(a)
+        elif o == "--samplesPercent":
+            options.samplesPercent = safeReadInt(a)
+        elif o == "--relative":
+            options.relatives.append(a)
+        elif o == "--refGene":
+            options.refGene = a
+        elif o == "--startslack":
+            options.startslack = safeReadInt(a)
+        elif o == "--spliceslack":
+            options.spliceslack = safeReadInt(a)
+        elif o == "--nocache":
+            options.cache = False
+        elif o == "--peBin":
+            options.peBin = a
+        elif o == "--peKeep":
+            options.peKeep = a
+        elif o == "--peLog":
+            options.peLog = a
+        elif o == "--bin":
+            options.bin = a
+        elif o == "--keep":
+            options.keep = a
+        elif o == "--log":
+            options.log = a
+        elif o == "--annotations":
+            options.annotations = a
+        elif o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        else:
+            options.setEvidenceOption(o, a)
+    if not options.check():
+        print('Incorrect arguments')
+        usage()
+        exit(2)
+    if options.stats:
+        startStats('favr_pipeline')
+    runPipeline(options)
+    finishStats(options.stats)
+
+def runPipeline(options):
+    with statsStage('read variants'):
+        rows = list(readVariantRows(options.variants))
+    variantsRead = len(rows)
+    # the counts of the variants in each bam file which has been read,
+    # so that a bam file is only read once
+    bamCounts = {}
+    if options.sample:
+        with pipelineStage('pe bias'):
+            rows = peBiasStage(options, rows)
+    if options.comparators:
+        with pipelineStage('filter'):
+            rows = filterStage(options, rows, bamCounts)
+    if options.relatives:
+        with pipelineStage('family'):
+            rows = familyStage(options, rows, bamCounts)
+    if options.refGene:
+        with pipelineStage('refGene'):
+            rows = refGeneStage(options, rows)
+    # after the stages, whose counts of the variants are moved away
+    countStat('variants', variantsRead)
+    with openOutput(options.output, 'w', '\t') as output:
+        csvWriter = csv.writer(output, delimiter='\t', quotechar='|')
+        for row in rows:
+            csvWriter.writerow(row)
+
+@contextmanager
+def pipelineStage(name):
+    '''Time a stage of the pipeline. The variants the stage counts are saved
+    under the name of the stage (such as "filter variants"), as each stage
+    is given the variants kept by the stage before it.'''
+    with statsStage(name):
+        yield
+    renameStat('variants', name + ' variants')
+
+def sideOutput(filename, mode='w', delimiter=None):
+    '''Open a side output file (see openOutput), or the null device if it is not wanted.'''
+    return openOutput(filename if filename else os.devnull, mode, delimiter)
+
+def peBiasStage(options, rows):
+    '''Bin the variants which only appear on 35 base reads in the sample,
+    giving back the rows which are kept.'''
+    keptRows = []
+    # the column engine finds the read sizes too, with the same read filters
+    filters = options.filters if options.engine == 'column' else None
+    with pysam.Samfile(options.sample, "rb") as bam:
+        with sideOutput(options.peBin, 'w', '\t') as binFile:
+            with sideOutput(options.peKeep, 'wb', '\t') as keepFile:
+                with sideOutput(options.peLog, 'wb') as logFile:
+                    # the coordinates are comma separated in the first column
+                    variants = [row[0].split(',') if row else [] for row in rows]
+                    variants = prefetchVariants(variants, bam, options.sample, options.prefetch)
+                    for variant,row in izip(variants, rows):
+                        thirty_fives,fifties = count_read_sizes(variant, bam, readSize=options.readSize,
+                                                                filters=filters)
+                        # the side outputs hold the whole row, as the input line
+                        writeVariant((binFile, keepFile, logFile), ['\t'.join(row)], thirty_fives, fifties)
+                        if not isPeBiased(thirty_fives, fifties):
+                            keptRows.append(row)
+    return keptRows
+
+def countVariantTable(options, table, bamFilenames, bamCounts):
+    '''Count the variants of the table in each of the bam files which has
+    not been read yet, saving the counts of each variant by its coordinates
+    and base in bamCounts. Returns the counts of each bam file, one per
+    variant in the table.'''
+    unread = []
+    for bamFile in bamFilenames:
+        if bamFile not in bamCounts and bamFile not in unread:
+            unread.append(bamFile)
+    for bamFile,counts in zip(unread, countBamFiles(unread, [table] * len(unread), options)):
+        bamCounts[bamFile] = dict((variantKey(table, index), count) for index,count in enumerate(counts))
+    return [[bamCounts[bamFile][variantKey(table, index)] for index in xrange(len(table))]
+            for bamFile in bamFilenames]
+
+def variantKey(table, index):
+    return (table.chromosome(index), table.positions[index], table.variantBases[index])
+
+def filterStage(options, rows, bamCounts):
+    '''Bin the variants which are common in the comparators, giving back the
+    rows which are kept, sorted by coordinate.'''
+    table = VariantTable(rows)
+    evidence = initEvidence(table)
+    for counts in countVariantTable(options, table, options.comparators, bamCounts):
+        addCounts(evidence, table, counts)
+    with sideOutput(options.log) as logFile:
+        with sideOutput(options.bin) as binFile:
+            with sideOutput(options.keep, 'wb', '\t') as keepFile:
+                csvWriter = csv.writer(keepFile, delimiter='\t', quotechar='|')
+                return writeClassifications(options, evidence, logFile, binFile, csvWriter)
+
+def familyStage(options, rows, bamCounts):
+    '''Annotate the variants which appear in a relative, giving back the
+    annotated rows: those in a relative first, then the others.'''
+    titleRow = None
+    # as in favr_family_annotate.py, the first row is a title if it is not a variant
+    if rows and not parseVariantRow(rows[0]):
+        titleRow = rows[0]
+        rows = rows[1:]
+    table = VariantTable(rows)
+    evidence = initEvidence(table)
+    for counts in countVariantTable(options, table, options.relatives, bamCounts):
+        addCounts(evidence, table, counts)
+    annotated = ([titleRow] if titleRow else []) + annotatedRows(options, evidence)
+    if options.annotations:
+        with openOutput(options.annotations, 'w', '\t') as annotateFile:
+            csvWriter = csv.writer(annotateFile, delimiter='\t', quotechar='|')
+            for row in annotated:
+                csvWriter.writerow(row)
+    return annotated
+
+def refGeneStage(options, rows):
+    '''Annotate the variants with the features of the refGene file which they overlap.'''
+    refGene = loadRefGene(options)
+    return list(annotateRows(rows, refGene))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+'''
+Read ahead in BAM files, for file systems where every seek is slow.
+
+Counting a variant seeks to the part of the BAM file which covers it, and
+waits for it to be read. On a network or parallel file system each of
+these reads can take a long time, while the CPU has nothing to do. The
+Prefetcher reads the parts of the BAM file covering the next few variants
+in background threads, while the current variant is being counted, so
+that by the time samtools seeks to them they are already in the operating
+system's page cache.
+
+The parts of the BAM file covering a region are found from its index
+(.bai) file, as samtools would: the chunks of the bins overlapping the
+region, after the offset given by the linear index. At most a fixed number
+of variants are read ahead of the one being counted. BAM files without a
+.bai index (such as those only indexed with .csi) are counted without
+reading ahead, with a warning.
+
+SimulatedStorage gives files which take a fixed time to read each block
+which has not been read before, to try out the prefetcher without a slow
+file system.
+'''
+
+import struct
+import threading
+import os
+import sys
+import time
+
+# the number of variants to read ahead of the one being counted, unless told otherwise
+defaultPrefetchDepth = 16
+# the number of threads reading ahead in each BAM file
+prefetchThreads = 2
+# the size of each read from the BAM file, and the largest BGZF block
+prefetchReadSize = 65536
+bgzfMaxBlockSize = 65536
+# the pseudo-bin of a reference in a BAM index, which holds metadata, not chunks
+metadataBin = 37450
+# the linear index of a BAM index has one offset for each 16kb window
+linearWindowShift = 14
+
+def readBamIndex(filename):
+    '''Read a BAM index (.bai) file, giving the bins and linear index of each reference.'''
+    with open(filename, 'rb') as indexFile:
+        data = indexFile.read()
+    if data[:4] != 'BAI\1':
+        raise Exception, 'not a BAM index file: ' + filename
+    offset = 4
+    (referenceCount,) = struct.unpack_from('<i', data, offset)
+    offset += 4
+    references = []
+    for reference in xrange(referenceCount):
+        (binCount,) = struct.unpack_from('<i', data, offset)
+        offset += 4
+        bins = {}
+        for n in xrange(binCount):
+            bin, chunkCount = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            chunks = struct.unpack_from('<%dQ' % (2 * chunkCount), data, offset)
+            offset += 16 * chunkCount
+            if bin != metadataBin:
+                bins[bin] = zip(chunks[0::2], chunks[1::2])
+        (intervalCount,) = struct.unpack_from('<i', data, offset)
+        offset += 4
+        linear = struct.unpack_from('<%dQ' % intervalCount, data, offset)
+        offset += 8 * intervalCount
+        references.append(BamIndexReference(bins, linear))
+    return references
+
+def bamIndexFilename(bamFilename):
+    '''The index of a BAM file: file.bam.bai, or else file.bai, or None if
+    there is neither.'''
+    for indexFilename in [bamFilename + '.bai', os.path.splitext(bamFilename)[0] + '.bai']:
+        if os.path.exists(indexFilename):
+            return indexFilename
+    return None
+
+# the BAM files which have been warned about, so each is only warned about once
+unprefetchableBams = set()
+
+def canPrefetch(bamFilename):
+    '''True if the BAM file has a .bai index to find the parts to read
+    ahead from. If not, warns (once for each BAM file) that it is counted
+    without reading ahead.'''
+    if bamIndexFilename(bamFilename) != None:
+        return True
+    if bamFilename not in unprefetchableBams:
+        unprefetchableBams.add(bamFilename)
+        sys.stderr.write('warning: no .bai index for %s, counting it without --prefetch\n' % bamFilename)
+    return False
+
+class BamIndexReference(object):
+    '''The index of one reference (chromosome) of a BAM file.'''
+    def __init__(self, bins, linear):
+        self.bins = bins      # bin number -> list of (start, end) virtual file offsets
+        self.linear = linear  # smallest virtual file offset of a read in each 16kb window
+    def byteRanges(self, start, end):
+        '''The sorted, merged (offset, length) ranges of the BAM file holding
+        the reads which overlap the 0-based, half open region start..end.'''
+        window = start >> linearWindowShift
+        minOffset = self.linear[window] if window < len(self.linear) else 0
+        ranges = []
+        for bin in regionBins(start, end):
+            for chunkStart, chunkEnd in self.bins.get(bin, []):
+                if chunkEnd > minOffset:
+                    # a virtual offset is the file offset of a BGZF block,
+                    # shifted left 16 bits, plus an offset in the block
+                    ranges.append((chunkStart >> 16, (chunkEnd >> 16) + bgzfMaxBlockSize))
+        merged = []
+        for rangeStart, rangeEnd in sorted(ranges):
+            if merged and rangeStart <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], rangeEnd)
+            else:
+                merged.append([rangeStart, rangeEnd])
+        return [(rangeStart, rangeEnd - rangeStart) for rangeStart, rangeEnd in merged]
+
+def regionBins(start, end):
+    '''The bins which may hold reads overlapping the 0-based, half open region
+    start..end, as in the SAM specification.'''
+    end -= 1
+    bins = [0]
+    for shift, first in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(xrange(first + (start >> shift), first + (end >> shift) + 1))
+    return bins
+
+class Prefetcher(object):
+    '''Read the parts of a BAM file covering a list of regions, in order, in
+    background threads, staying at most depth regions ahead of the region
+    being counted. The regions are (chromosome, start, end), 0-based and
+    half open, or None for nothing to read. Call advance with the index of
+    each region as it is counted, and close when done. The BAM file must
+    have a .bai index (see canPrefetch).'''
+    def __init__(self, bamFilename, references, regions, depth=defaultPrefetchDepth,
+                 threads=prefetchThreads, opener=open):
+        self.bamFilename = bamFilename
+        self.referenceIds = dict((name, index) for index, name in enumerate(references))
+        self.regions = regions
+        self.depth = depth
+        self.opener = opener
+        indexFilename = bamIndexFilename(bamFilename)
+        if indexFilename == None:
+            raise Exception, 'no .bai index to prefetch from: ' + bamFilename
+        self.index = readBamIndex(indexFilename)
+        self.condition = threading.Condition()
+        self.current = 0  # the index of the region being counted
+        self.next = 0     # the index of the next region to read
+        self.closed = False
+        self.threads = [threading.Thread(target=self.run) for n in xrange(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def advance(self, index):
+        '''Tell the prefetcher that the region at index is being counted.'''
+        with self.condition:
+            self.current = index
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def nextRegion(self):
+        '''The index of the next region to read, waiting until it is within
+        depth of the region being counted, or None when there are no more.'''
+        with self.condition:
+            while not self.closed and self.next < len(self.regions) and \
+                    self.next >= self.current + self.depth:
+                self.condition.wait()
+            if self.closed or self.next >= len(self.regions):
+                return None
+            index = self.next
+            self.next += 1
+            return index
+
+    def run(self):
+        # each thread reads with its own file handle
+        with self.opener(self.bamFilename, 'rb') as bamFile:
+            while True:
+                index = self.nextRegion()
+                if index == None:
+                    return
+                # skip regions which have already been counted
+                if index < self.current or self.regions[index] == None:
+                    continue
+                readRanges(bamFile, self.byteRanges(self.regions[index]))
+
+    def byteRanges(self, region):
+        '''The (offset, length) ranges of the BAM file covering a region.'''
+        chr, start, end = region
+        referenceId = self.referenceIds.get(chr)
+        if referenceId == None or referenceId >= len(self.index):
+            return []
+        return self.index[referenceId].byteRanges(start, end)
+
+def readRanges(bamFile, ranges):
+    '''Read the (offset, length) ranges of an open file, throwing the data away.'''
+    for offset, length in ranges:
+        bamFile.seek(offset)
+        while length > 0:
+            data = bamFile.read(min(length, prefetchReadSize))
+            if not data:
+                break
+            length -= len(data)
+
+def prefetching(items, prefetcher):
+    '''Yield the items, one for each region, in turn, telling the prefetcher
+    as each one is done, and closing it at the end.'''
+    try:
+        for index, item in enumerate(items):
+            prefetcher.advance(index + 1)
+            yield item
+    finally:
+        prefetcher.close()
+
+class SimulatedStorage(object):
+    '''Files which take latency seconds to read each block of blockSize bytes
+    which has not been read before from the same storage, as on a slow file
+    system with a page cache. Counts the reads, the blocks which were not
+    cached, and the most reads in flight at the same time.'''
+    def __init__(self, latency, blockSize=prefetchReadSize):
+        self.latency = latency
+        self.blockSize = blockSize
+        self.lock = threading.Lock()
+        self.cached = set()  # (file name, block number) of the blocks read before
+        self.reads = 0
+        self.uncachedBlocks = 0
+        self.inFlight = 0
+        self.maxInFlight = 0
+
+    def open(self, filename, mode='rb'):
+        return LatencyFile(self, filename, mode)
+
+    def readBlocks(self, filename, offset, length):
+        '''Wait for the blocks of a read which are not cached yet.'''
+        blocks = set((filename, block) for block in
+                     xrange(offset / self.blockSize, (offset + max(length, 1) - 1) / self.blockSize + 1))
+        with self.lock:
+            uncached = blocks - self.cached
+            self.cached.update(blocks)
+            self.reads += 1
+            self.uncachedBlocks += len(uncached)
+            self.inFlight += 1
+            self.maxInFlight = max(self.maxInFlight, self.inFlight)
+        try:
+            if uncached:
+                time.sleep(self.latency * len(uncached))
+        finally:
+            with self.lock:
+                self.inFlight -= 1
+
+class LatencyFile(object):
+    '''A file of a SimulatedStorage.'''
+    def __init__(self, storage, filename, mode):
+        self.storage = storage
+        self.filename = filename
+        self.file = open(filename, mode)
+    def seek(self, offset, whence=0):
+        self.file.seek(offset, whence)
+    def tell(self):
+        return self.file.tell()
+    def read(self, size=-1):
+        offset = self.file.tell()
+        data = self.file.read(size)
+        self.storage.readBlocks(self.filename, offset, len(data))
+        return data
+    def close(self):
+        self.file.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
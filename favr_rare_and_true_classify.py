@@ -20,6 +20,12 @@ Authors: Bernie Pope, Danny Park, Fabrice Odefrey, Tu Nguyen-Dumont.
 #varLikeThresh = 1   # how many reads of the variant do we need to see in a single sample?
 #samplesPercent = 30 # what percentage of the total samples need to pass the above threshold?
 
+# NumPy is optional. Without it, classifyAll calls classify once per variant.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Classify(object):
     def __init__(self, action, reason):
         self.action = action # 'bin' or 'keep'
@@ -50,6 +56,97 @@ def classify(options, variantInfo):
     else:
         return Classify('bin', binZeroSamplesMessage)
 
+# classify_decided is the action classify will give a variant whatever the
+# counts of the samples which have not been counted yet, or None if they
+# could still change it, where variantInfo holds the (readCount, depth)
+# pairs of the samples counted so far, out of totalSamples. It is used to
+# stop counting a variant in more samples (see --adaptive).
+#
+# If you rewrite the classify function, rewrite this one to match it (or
+# make it always return None).
+def classify_decided(options, variantInfo, totalSamples):
+    if totalSamples == 0:
+        return 'bin'
+    binableSamples = len([readCount for readCount,_depth in variantInfo if readCount >= options.varLikeThresh])
+    uncounted = totalSamples - len(variantInfo)
+    if (binableSamples * 100 / totalSamples) >= options.samplesPercent:
+        # already binable, even if none of the other samples are
+        return 'bin'
+    if ((binableSamples + uncounted) * 100 / totalSamples) < options.samplesPercent:
+        # not binable, even if all of the other samples are
+        return 'keep'
+    return None
+
 binThresholdMessage = '(binableSamples(=%d) * 100 / totalSamples(=%d)) >= samplesPercent(=%d)'
 binZeroSamplesMessage = 'there were zero samples to compare with'
 keepMessage = '(binableSamples(=%d) * 100 / totalSamples(=%d)) < samplesPercent(=%d)'
+
+# classify_batch is a vectorized version of classify, which classifies many
+# variants at once from a NumPy matrix of counts with shape
+# (variants, samples, 2), where
+#    matrix[v, s, 0] is the readCount of variant v in sample s
+#    matrix[v, s, 1] is the depth of variant v in sample s
+# and totalSamples[v] is the number of samples of variant v. Variants with
+# fewer samples than the matrix are padded with a readCount of -1, which is
+# never binable. It returns an array which is True for each variant that
+# should be binned, and the number of binable samples of each variant.
+#
+# If you rewrite the classify function, rewrite this one to match it (or
+# set numpy = None above to always use classify).
+def classify_batch(options, matrix, totalSamples):
+    binableSamples = (matrix[:, :, 0] >= options.varLikeThresh).sum(axis=1)
+    # the same integer division as classify, avoiding division by zero
+    percents = (binableSamples * 100) // numpy.maximum(totalSamples, 1)
+    isBin = (totalSamples == 0) | (percents >= options.samplesPercent)
+    return isBin, binableSamples
+
+# A classification made by classify_batch, which only formats its reason
+# when it is asked for, such as when it is written to the log.
+class BatchClassify(object):
+    __slots__ = ['action', 'binableSamples', 'totalSamples', 'samplesPercent']
+    def __init__(self, action, binableSamples, totalSamples, samplesPercent):
+        self.action = action
+        self.binableSamples = binableSamples
+        self.totalSamples = totalSamples
+        self.samplesPercent = samplesPercent
+    @property
+    def reason(self):
+        if self.totalSamples == 0:
+            return binZeroSamplesMessage
+        elif self.action == 'bin':
+            return binThresholdMessage % (self.binableSamples, self.totalSamples, self.samplesPercent)
+        else:
+            return keepMessage % (self.binableSamples, self.totalSamples, self.samplesPercent)
+
+# the number of variants classified by each call to classify_batch, which
+# bounds the size of the count matrix
+classifyBlockSize = 65536
+
+def classifyAll(options, variantInfos):
+    '''Classify a list of variants, each one a list of (readCount, depth) pairs,
+    with classify_batch if NumPy is available, otherwise with classify.'''
+    if numpy is None:
+        return [classify(options, variantInfo) for variantInfo in variantInfos]
+    classifications = []
+    for blockStart in xrange(0, len(variantInfos), classifyBlockSize):
+        block = variantInfos[blockStart:blockStart + classifyBlockSize]
+        matrix, totalSamples = countMatrix(block)
+        isBin, binableSamples = classify_batch(options, matrix, totalSamples)
+        for binned, binable, total in zip(isBin.tolist(), binableSamples.tolist(), totalSamples.tolist()):
+            classifications.append(BatchClassify('bin' if binned else 'keep', binable, total, options.samplesPercent))
+    return classifications
+
+def countMatrix(variantInfos):
+    '''Make the (variants, samples, 2) count matrix and totalSamples array for classify_batch.'''
+    totalSamples = numpy.array([len(variantInfo) for variantInfo in variantInfos], dtype=numpy.int64)
+    samples = int(totalSamples.max()) if len(variantInfos) > 0 else 0
+    if samples > 0 and (totalSamples == samples).all():
+        # the usual case: every variant has one count per sample
+        matrix = numpy.array(variantInfos, dtype=numpy.int64)
+    else:
+        matrix = numpy.empty((len(variantInfos), samples, 2), dtype=numpy.int64)
+        matrix.fill(-1)
+        for index, variantInfo in enumerate(variantInfos):
+            if variantInfo:
+                matrix[index, :len(variantInfo)] = variantInfo
+    return matrix, totalSamples
@@ -33,6 +33,37 @@ Revision history:
 
 14 Nov 2011.   Added classify arguments to the command line.
 
+16 Oct 2026.   Added --jobs to count the variants in several BAM files
+               in parallel, and --engine to choose how they are counted.
+
+17 Oct 2026.   Added --chunkSize to filter coordinate sorted variants in
+               chunks, without reading them all into memory.
+               Added --region, --shard and --shardBy to filter part of
+               the variants.
+               Added --panel to look up the evidence in a panel of
+               comparators made by favr_panel_build.py.
+               Sort the variants on precomputed keys, and added --reference
+               to sort them in the chromosome order of a reference.
+               Added --stats to save the time taken by each stage, and
+               counters of the work done, in a JSON report.
+               Added --prefetch to read ahead in the BAM files while
+               counting, for slow (network) file systems.
+               Added --engine=column to take the bases of each pileup
+               column in one call, and the read filters --minBaseQual,
+               --minMapQual, --flagFilter and --maxDepth.
+               Tally each site once in each BAM file, and count every
+               variant at it from the tally. Variants with the same
+               coordinates no longer overwrite each other.
+               Added --batch to filter the variant lists of many probands
+               against the same comparators, reading each comparator BAM
+               file once for all of them.
+               Added --adaptive to stop counting a variant in more BAM
+               files once its classification is fixed, with --adaptiveBlock
+               and --adaptiveOrder. The --bin and --log files are optional.
+               Read VCF files and bgzip compressed variant lists, only
+               reading the variants in the --region when they are indexed.
+               Write bgzip compressed outputs when their names end in .gz.
+
 '''
 
 import os
@@ -41,35 +72,64 @@ import sys
 import csv
 import yaml
 import getopt
-from favr_common import (safeReadInt, getEvidence, makeSafeFilename, sortByCoord)
-from favr_rare_and_true_classify import classify
+from contextlib import contextmanager
+from favr_common import (safeReadInt, getEvidence, getBatchEvidence, makeSafeFilename, sortByCoord, EvidenceOptions,
+                         evidenceOptionsFlags, sortedVariantChunks, selectVariants, variantSelector, BamCounter,
+                         startStats, finishStats, statsStage, countStat)
+from favr_rare_and_true_classify import (classifyAll, classify_decided)
+from favr_variant_io import (readVariantRows, openOutput)
 
 # print a usage message
 def usage():
     print("""Usage: %s
     [-h | --help]
     --variants=<variant list as TSV file>
-    --bin=<bin filename>
+    [--bin=<bin filename>]
     --keep=<keep filename>
-    --log=<log filename>
+    [--log=<log filename>]
     --varLikeThresh=<variant read threshold>
     --samplesPercent=<percent of total samples which pass the threshold>
+    [--batch=<file listing variant, bin, keep and log file names>]
+    [--jobs=<number of BAM files to process in parallel>]
+    [--engine=<pileup | sweep | fetch | column>]
+    [--minBaseQual=<least base quality, column engine only>]
+    [--minMapQual=<least mapping quality, column engine only>]
+    [--flagFilter=<SAM flags of reads to leave out, column engine only>]
+    [--maxDepth=<most reads in a pileup column, column engine only>]
+    [--chunkSize=<number of sorted variants to filter at a time>]
+    [--region=<chr:start-end>]
+    [--shard=<i/N>]
+    [--shardBy=<window | chromosome>]
+    [--evidenceCache=<cache file>]
+    [--evidenceCacheSize=<most counts to keep in the cache>]
+    [--panel=<panel directory>]
+    [--reference=<BAM file or .fai file>]
+    [--stats=<JSON statistics report file>]
+    [--prefetch=<number of variants to read ahead in each BAM file>]
+    [--adaptive]
+    [--adaptiveBlock=<number of variants counted adaptively at a time>]
+    [--adaptiveOrder=<given | hits>]
     reads1.bam reads2.bam ...""") % sys.argv[0]
 
-longOptionsFlags = ["help", "variants=", "bin=", "keep=", "log=", "varLikeThresh=", "samplesPercent="]
+longOptionsFlags = ["help", "variants=", "bin=", "keep=", "log=", "varLikeThresh=", "samplesPercent=",
+                    "chunkSize=", "batch="] + evidenceOptionsFlags
 shortOptionsFlags = "h"
 
 # A place to store command line arguments.
-class Options(object):
+class Options(EvidenceOptions):
     def __init__(self):
+        super(Options, self).__init__()
         self.variants = None
         self.bin = None
         self.keep = None
         self.log = None
         self.varLikeThresh = None
         self.samplesPercent = None
+        self.chunkSize = None
+        self.batch = None
     def check(self):
-        return all([self.variants, self.bin, self.keep, self.log, self.varLikeThresh, self.samplesPercent])
+        return (all([self.variants, self.keep]) or self.batch != None) and \
+            self.varLikeThresh != None and self.samplesPercent != None
 
 def main():
     try:
@@ -92,44 +152,147 @@ def main():
             options.varLikeThresh = safeReadInt(a)
         elif o == "--samplesPercent":
             options.samplesPercent = safeReadInt(a)
+        elif o == "--chunkSize":
+            options.chunkSize = safeReadInt(a)
+        elif o == "--batch":
+            options.batch = a
         elif o in ('-h', '--help'):
             usage()
             sys.exit(0)
+        else:
+            options.setEvidenceOption(o, a)
     if not options.check():
         print('Incorrect arguments')
         usage()
         exit(2)
     bamFilenames = args
-    # Read the rows of the variants TSV file into a list.
-    with open(options.variants) as variants:
-        variantList = list(csv.reader(variants, delimiter='\t', quotechar='|'))
-    # compute the presence/absence of each variant in the bam files
-    evidence = getEvidence(variantList, bamFilenames)
-    # filter the variants
-    filter(options, evidence)
+    if options.stats:
+        startStats('favr_rare_and_true_filter')
+    if options.batch != None:
+        if options.chunkSize:
+            raise Exception, '--chunkSize can not be used with --batch'
+        if options.adaptive:
+            raise Exception, '--adaptive can not be used with --batch'
+        filterBatch(options, bamFilenames)
+    elif options.chunkSize:
+        filterStream(options, bamFilenames)
+    else:
+        # Read the rows of the variants TSV file into a list.
+        with statsStage('read variants'):
+            variantList = list(readVariantRows(options.variants, region=options.region))
+            # only keep the variants in the region and shard of this run
+            variantList = selectVariants(variantList, options)
+        # compute the presence/absence of each variant in the bam files
+        evidence = getEvidence(variantList, bamFilenames, options, adaptiveDecision(options))
+        # filter the variants
+        filter(options, evidence)
+    finishStats(options.stats)
 
 def filter(options, evidence):
     '''Decide which variants to keep and which to bin.'''
-    binFilename =  options.bin
-    keepFilename = options.keep
-    logFilename = options.log
-    with open (logFilename,'w') as logFile:
-        with open(binFilename,'w') as binFile:
-            with open(keepFilename,'wb') as keepFile:
+    with openFilterOutputs(options.log, options.bin, options.keep) as (logFile, binFile, csvWriter):
+        writeClassifications(options, evidence, logFile, binFile, csvWriter)
+
+def filterBatch(options, bamFilenames):
+    '''Filter each variant list of the batch file against the same samples.
+    The variants of all of the lists are counted together (see
+    getBatchEvidence), then each list is classified and written on its own,
+    the same as filtering it in a run of its own.'''
+    batch = readBatch(options.batch)
+    with statsStage('read variants'):
+        variantLists = []
+        for variantsFilename, binFilename, keepFilename, logFilename in batch:
+            variantList = list(readVariantRows(variantsFilename, region=options.region))
+            # only keep the variants in the region and shard of this run
+            variantLists.append(selectVariants(variantList, options))
+    evidences = getBatchEvidence(variantLists, bamFilenames, options)
+    for (variantsFilename, binFilename, keepFilename, logFilename),evidence in zip(batch, evidences):
+        with openFilterOutputs(logFilename, binFilename, keepFilename) as (logFile, binFile, csvWriter):
+            writeClassifications(options, evidence, logFile, binFile, csvWriter)
+
+def readBatch(batchFilename):
+    '''Read the (variants, bin, keep, log) file names from the batch file,
+    one variant list per line, separated by tabs.'''
+    batch = []
+    with open(batchFilename) as batchFile:
+        for row in csv.reader(batchFile, delimiter='\t', quotechar='|'):
+            if len(row) >= 4:
+                batch.append(tuple(row[:4]))
+            elif len(row) > 0:
+                raise Exception, 'batch file line needs variant, bin, keep and log file names: ' + '\t'.join(row)
+    return batch
+
+def filterStream(options, bamFilenames):
+    '''Filter a coordinate sorted variants file in chunks of options.chunkSize
+    variants, writing the output for each chunk before reading the next.
+    The output is the same as filtering the whole file at once. The pool of
+    workers and the evidence cache are kept for all of the chunks.'''
+    # sharding needs all of the variants to decide which ones are in
+    # this shard, so read them once up front, but without keeping them
+    selector = variantSelector(options, readVariantRows(options.variants, region=options.region))
+    counter = None if options.panel else BamCounter(bamFilenames, options)
+    try:
+        with openFilterOutputs(options.log, options.bin, options.keep) as (logFile, binFile, csvWriter):
+            variantRows = readVariantRows(options.variants, region=options.region)
+            for variantList in sortedVariantChunks(variantRows, options.chunkSize, options.coordOrder):
+                if selector != None:
+                    variantList = [row for row in variantList if selector.selects(row)]
+                evidence = getEvidence(variantList, bamFilenames, options, adaptiveDecision(options), counter)
+                writeClassifications(options, evidence, logFile, binFile, csvWriter)
+    finally:
+        if counter != None:
+            counter.close()
+
+def adaptiveDecision(options):
+    '''With --adaptive, a variant needs no more counts once classify_decided
+    fixes its action, unless the output shows its counts: the log shows the
+    binable samples of every variant, and the bin file the counts of the
+    binned ones. With a log, every variant is counted in every BAM file.'''
+    if options.log:
+        return None
+    def decided(counts, totalSamples):
+        action = classify_decided(options, counts, totalSamples)
+        return action == 'keep' or (action == 'bin' and not options.bin)
+    return decided
+
+@contextmanager
+def openFilterOutputs(logFilename, binFilename, keepFilename):
+    '''Open the log, bin and keep files, giving a csv writer for the keep file.
+    The log and bin files are not written if they are not given. Files
+    whose names end in .gz are bgzip compressed, and the keep file indexed.'''
+    with openOutput(logFilename or os.devnull,'w') as logFile:
+        with openOutput(binFilename or os.devnull,'w') as binFile:
+            with openOutput(keepFilename,'wb','\t') as keepFile:
                 csvWriter = csv.writer(keepFile, delimiter='\t', quotechar='|')
-                # sort the variants by coordinate
-                for key,info in sortByCoord(evidence):
-                    classification = classify(options, info.counts)
-                    # record the classification of this variant in the logfile
-                    logFile.write("%s: %s: %s\n" % (key, classification.action, classification.reason))
-                    if classification.action == 'bin':
-                        # bin the variant
-                        binFile.write('%s\n' % key)
-                        for readCount,depth in info.counts:
-                            binFile.write('    <vars/coverage: %d/%d>\n' % (readCount,depth))
-                    elif classification.action == 'keep':
-                        # keep the variant
-                        csvWriter.writerow(info.inputRow)
+                yield logFile, binFile, csvWriter
+
+def writeClassifications(options, evidence, logFile, binFile, csvWriter):
+    # sort the variants by coordinate
+    with statsStage('sort'):
+        sortedEvidence = sortByCoord(evidence, options.coordOrder)
+    with statsStage('classify'):
+        classifications = classifyAll(options, [info.counts for key,info in sortedEvidence])
+    with statsStage('write'):
+        keptRows = writeOutputs(sortedEvidence, classifications, logFile, binFile, csvWriter)
+    countStat('variants', len(sortedEvidence))
+    return keptRows
+
+def writeOutputs(sortedEvidence, classifications, logFile, binFile, csvWriter):
+    '''Write the log, bin and keep files, returning the rows of the kept variants.'''
+    keptRows = []
+    for (key,info),classification in zip(sortedEvidence, classifications):
+        # record the classification of this variant in the logfile
+        logFile.write("%s: %s: %s\n" % (info.id, classification.action, classification.reason))
+        if classification.action == 'bin':
+            # bin the variant
+            binFile.write('%s\n' % info.id)
+            for readCount,depth in info.counts:
+                binFile.write('    <vars/coverage: %d/%d>\n' % (readCount,depth))
+        elif classification.action == 'keep':
+            # keep the variant
+            csvWriter.writerow(info.inputRow)
+            keptRows.append(info.inputRow)
+    return keptRows
 
 if __name__ == "__main__":
    main()
@@ -16,13 +16,27 @@ Revision history:
 24 Oct 2011.    Fixed coordinate issue.
 15 Nov 2011.    Fixed coordinate issue with exon start/end depending on
                 strand.
+16 Oct 2026.    Index the features on each chromosome, so that searching
+                for a variant takes logarithmic time.
+                Cache the compiled index next to the refGene file.
+                Added --batch to annotate many variant files in one run.
+17 Oct 2026.    Added --stats to save the time taken by each stage, and
+                counters of the work done, in a JSON report.
+                Read VCF files and bgzip compressed variant lists, and write
+                bgzip compressed outputs when their names end in .gz.
 '''
 
 import os
 import sys
 import csv
 import getopt
-from favr_common import safeReadInt
+import multiprocessing
+import bisect
+import heapq
+from array import array
+from favr_common import (safeReadInt, startStats, finishStats, statsStage, countStat, recordingStats,
+                         addWorkerCounters, workerStats, takeWorkerCounters)
+from favr_variant_io import (readVariantRows, openOutput)
 
 # print a usage message
 def usage():
@@ -32,9 +46,23 @@ def usage():
     --startslack=<distance from start of coding region>
     --spliceslack=<distance from exon start/end sites>
     --refGene=<refGene.txt file>
-    --output=<output file name>""") % sys.argv[0]
+    --output=<output file name>
+    [--nocache]
+    [--stats=<JSON statistics report file>]
 
-longOptionsFlags = ["help", "variants=", "refGene=", "startslack=", "spliceslack=", "output="]
+    or, to annotate many variant files against the same refGene file:
+
+    [-h | --help]
+    --batch=<file listing variant and output file names>
+    --startslack=<distance from start of coding region>
+    --spliceslack=<distance from exon start/end sites>
+    --refGene=<refGene.txt file>
+    [--jobs=<number of variant files to annotate in parallel>]
+    [--nocache]
+    [--stats=<JSON statistics report file>]""") % sys.argv[0]
+
+longOptionsFlags = ["help", "variants=", "refGene=", "startslack=", "spliceslack=", "output=", "nocache",
+                    "batch=", "jobs=", "stats="]
 shortOptionsFlags = "h"
 
 # A place to store command line arguments.
@@ -45,12 +73,15 @@ class Options(object):
         self.spliceslack = None
         self.startslack = None
         self.output = None
+        self.cache = True
+        self.batch = None
+        self.jobs = 1
+        self.stats = None
     def check(self):
         return (self.refGene != None and
-                self.variants != None and
+                ((self.variants != None and self.output != None) or self.batch != None) and
                 self.spliceslack != None and
-                self.startslack != None and
-                self.output != None)
+                self.startslack != None)
 
 def main():
     try:
@@ -71,6 +102,14 @@ def main():
             options.startslack = safeReadInt(a)
         elif o == "--output":
             options.output = a
+        elif o == "--nocache":
+            options.cache = False
+        elif o == "--batch":
+            options.batch = a
+        elif o == "--jobs":
+            options.jobs = safeReadInt(a)
+        elif o == "--stats":
+            options.stats = a
         elif o in ('-h', '--help'):
             usage()
             sys.exit(0)
@@ -78,138 +117,243 @@ def main():
         print('Incorrect arguments')
         usage()
         exit(2)
-    refGene = readRefGene(options)
+    if options.stats:
+        startStats('favr_refgene_annotate')
+    with statsStage('load refGene'):
+        refGene = loadRefGene(options)
+    countStat('refGene index segments', sum(len(index.segmentStarts) for index in refGene.values()))
     #showRefGene(refGene)
-    annotate(options, refGene)
+    with statsStage('annotate'):
+        if options.batch != None:
+            annotateBatch(options, refGene)
+        else:
+            annotate(options, refGene)
+    finishStats(options.stats)
 
 def annotate(options, refGene):
-    with open(options.output, 'w') as output:
+    annotateFile(options.variants, options.output, refGene)
+
+def annotateBatch(options, refGene):
+    '''Annotate every variant file listed in the batch file against the same refGene.'''
+    batch = readBatch(options.batch)
+    if options.jobs > 1 and len(batch) > 1:
+        # the workers are forked after refGene has been loaded, so they
+        # share it instead of loading it again
+        global workerRefGene
+        workerRefGene = refGene
+        pool = multiprocessing.Pool(processes = min(options.jobs, len(batch)),
+                                    initializer = workerStats, initargs = (recordingStats(),))
+        try:
+            for counters in pool.map(annotateBatchEntry, batch):
+                addWorkerCounters(counters)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for variantsFilename, outputFilename in batch:
+            annotateFile(variantsFilename, outputFilename, refGene)
+
+def readBatch(batchFilename):
+    '''Read the (variants, output) file name pairs from the batch file,
+    one pair per line, separated by a tab.'''
+    batch = []
+    with open(batchFilename) as batchFile:
+        for row in csv.reader(batchFile, delimiter='\t', quotechar='|'):
+            if len(row) >= 2:
+                batch.append((row[0], row[1]))
+            elif len(row) == 1:
+                raise Exception, 'batch file line has no output file name: ' + row[0]
+    return batch
+
+# The refGene shared by the batch worker processes.
+workerRefGene = None
+
+def annotateBatchEntry(entry):
+    variantsFilename, outputFilename = entry
+    annotateFile(variantsFilename, outputFilename, workerRefGene)
+    return takeWorkerCounters()
+
+def annotateFile(variantsFilename, outputFilename, refGene):
+    with openOutput(outputFilename, 'w', '\t') as output:
         csvWriter = csv.writer(output, delimiter='\t', quotechar='|')
-        # Read the rows of the variants TSV file into a list.
-        with open(options.variants) as variants:
-            for row in csv.reader(variants, delimiter='\t', quotechar='|'):
-                if len(row) >= 1:
-                    coords = row[0].split(',')
-                    if len(coords) >= 4 and coords[1].isdigit():
-                        chrName = "chr" + coords[0]
-                        pos = safeReadInt(coords[1])
-                        searchResult = search(chrName, pos, refGene)
-                        if searchResult != None:
-                            csvWriter.writerow(row + [searchResult])
-                        else:
-                            csvWriter.writerow(row)
+        for row in annotateRows(readVariantRows(variantsFilename), refGene):
+            csvWriter.writerow(row)
+
+def annotateRows(rows, refGene):
+    '''Yield each row with valid coordinates, with the annotation of its
+    coordinates added if it overlaps a feature. Other rows are left out.'''
+    for row in rows:
+        if len(row) >= 1:
+            coords = row[0].split(',')
+            if len(coords) >= 4 and coords[1].isdigit():
+                chrName = "chr" + coords[0]
+                pos = safeReadInt(coords[1])
+                searchResult = search(chrName, pos, refGene)
+                if searchResult != None:
+                    yield row + [searchResult]
+                else:
+                    yield row
 
 # search for the first feature in RefGene which overlaps this coordinate
 # and return its annotation (if such a feature exists).
 def search(chr, pos, refGene):
-    features = refGene.get(chr, [])
-    for f in features:
-        annotation = f.annotate(pos)
-        if annotation != None:
-            return annotation
-    return None
+    countStat('refGene searches')
+    index = refGene.get(chr)
+    if index == None:
+        return None
+    # the index finds the one segment of the chromosome holding pos
+    return index.search(pos)
 
 def showRefGene(refGene):
-    for chr, vals in refGene.items():
+    for chr, index in refGene.items():
         print("%s" % chr)
-        for v in vals:
-            print("\t%s" % str(v))
-
-class CodingRegionStart(object):
-    def __init__(self, direction, slack, start, end):
-        self.direction = direction
-        self.slack = slack
-        self.start = start
-        self.end = end
-        # upper bound is always greater than or equal to the lower bound
-        # in coordinate position, and coordinates are always based on the
-        # forward strand.
-        if self.direction == '+':
-            self.lowerBound = self.start - self.slack
-            self.upperBound = self.start - 1 # don't include the start in the region
-        else: # self.direction == '-'
-            self.upperBound = self.end + self.slack
-            self.lowerBound = self.end + 1 # don't include the end in the region
-
-    def annotate(self, pos):
-        if pos >= self.lowerBound and pos <= self.upperBound:
-            return 'Within %d before coding region start' % abs (self.start - pos)
+        for start, kind, anchor in zip(index.segmentStarts, index.segmentKinds, index.segmentAnchors):
+            print("\t%d %d %d" % (start, kind, anchor))
+
+# The kinds of feature in RefGene, which determine how a variant
+# inside the feature is annotated.
+CODING_REGION_START = 0
+CODING_EXON_START = 1
+CODING_EXON_END = 2
+NONCODING_EXON_START = 3
+NONCODING_EXON_END = 4
+PARTIAL_CODING_EXON_START = 5
+PARTIAL_CODING_EXON_END = 6
+
+# The annotation for each kind of feature, indexed by its kind. The
+# argument is the distance of the variant from the anchor coordinate of the
+# feature.
+annotationFormats = [
+    'Within %d before coding region start',
+    'Within %d of coding exon start boundary',
+    'Within %d of coding exon end boundary',
+    'Within %d of NON-coding exon start boundary',
+    'Within %d of NON-coding exon end boundary',
+    'Within %d of PARTIAL-coding exon start boundary',
+    'Within %d of PARTIAL-coding exon end boundary',
+]
+
+def formatAnnotation(kind, anchor, pos):
+    if kind == CODING_REGION_START:
+        return annotationFormats[kind] % abs(anchor - pos)
+    else:
+        return annotationFormats[kind] % (pos - anchor)
+
+# An index of the features on one chromosome. The chromosome is cut into
+# segments at every lower bound and every (upper bound + 1) of the features.
+# The features which overlap a position are the same for every position in a
+# segment, so for each segment we only need to remember the kind and anchor
+# of the first of them in file order. Searching is then a binary search for
+# the segment. The index is stored in flat arrays, so that it can be saved to
+# and loaded from the cache file quickly.
+class FeatureIndex(object):
+    def __init__(self, segmentStarts, segmentKinds, segmentAnchors):
+        # the start coordinate of each segment, in ascending order
+        self.segmentStarts = segmentStarts
+        # the kind of the first feature overlapping each segment, or -1 if
+        # there is no such feature
+        self.segmentKinds = segmentKinds
+        # the anchor coordinate of the first feature overlapping each segment
+        self.segmentAnchors = segmentAnchors
+
+    def search(self, pos):
+        segment = bisect.bisect_right(self.segmentStarts, pos) - 1
+        if segment >= 0 and self.segmentKinds[segment] >= 0:
+            return formatAnnotation(self.segmentKinds[segment], self.segmentAnchors[segment], pos)
+        return None
+
+def indexFeatures(features):
+    '''Build the FeatureIndex of the FeatureColumns of one chromosome.'''
+    index = FeatureIndex(array('i'), array('b'), array('i'))
+    lowerBounds, upperBounds = features.lowerBounds, features.upperBounds
+    # features with an empty region (zero slack) never overlap anything
+    nonEmpty = [(lowerBounds[i], i) for i in xrange(len(features)) if lowerBounds[i] <= upperBounds[i]]
+    nonEmpty.sort()
+    bounds = set()
+    for lowerBound, i in nonEmpty:
+        bounds.add(lowerBound)
+        bounds.add(upperBounds[i] + 1)
+    # the features overlapping the current segment, as a heap of
+    # (file position, upper bound), so the first one is on top
+    overlapping = []
+    next = 0
+    for start in sorted(bounds):
+        while next < len(nonEmpty) and nonEmpty[next][0] <= start:
+            i = nonEmpty[next][1]
+            heapq.heappush(overlapping, (i, upperBounds[i]))
+            next += 1
+        # drop features which ended before this segment
+        while overlapping and overlapping[0][1] < start:
+            heapq.heappop(overlapping)
+        if overlapping:
+            first = overlapping[0][0]
+            kind, anchor = features.kinds[first], features.anchors[first]
         else:
-            return None
+            kind, anchor = -1, 0
+        # neighbouring segments with the same annotation are merged
+        if not index.segmentKinds or (index.segmentKinds[-1], index.segmentAnchors[-1]) != (kind, anchor):
+            index.segmentStarts.append(start)
+            index.segmentKinds.append(kind)
+            index.segmentAnchors.append(anchor)
+    return index
+
+# The features on one chromosome, in file order. Each feature is a
+# (kind, anchor, lowerBound, upperBound) entry in parallel arrays, rather than
+# an object of its own, because the whole of refGene has hundreds of
+# thousands of features. A variant at a position between the lower and upper
+# bound (inclusive) of a feature is annotated with formatAnnotation.
+class FeatureColumns(object):
+    def __init__(self):
+        self.kinds = array('b')
+        self.anchors = array('i')
+        self.lowerBounds = array('i')
+        self.upperBounds = array('i')
+    def __len__(self):
+        return len(self.kinds)
+    def append(self, kind, anchor, bounds):
+        lowerBound, upperBound = bounds
+        self.kinds.append(kind)
+        self.anchors.append(anchor)
+        self.lowerBounds.append(lowerBound)
+        self.upperBounds.append(upperBound)
 
-    def __str__(self):
-        return "CodingRegionStart %d %d" % (self.upperBound, self.lowerBound)
+def codingRegionStartBounds(direction, slack, start, end):
+    # upper bound is always greater than or equal to the lower bound
+    # in coordinate position, and coordinates are always based on the
+    # forward strand.
+    if direction == '+':
+        return (start - slack, start - 1) # don't include the start in the region
+    else: # direction == '-'
+        return (end + 1, end + slack) # don't include the end in the region
 
-# All kinds of exon boundaries are sub-types of ExonBoundary
-# they differ in annotation and in the way they are printed.
+# All kinds of exon boundaries have the same bounds; they differ in
+# annotation.
 # This is a bit complicated because all coordinates in refgene are
 # given relative to the + strand (regardless of which strand the
 # gene appears on). So, on the - strand the start coordinate
 # is actually greater than the end coordinate.
 # We could collapse this test into two cases, but I think it is
 # easier to understand in the more elaborate form below.
-class ExonBoundary(object):
-    def __init__(self, slack, direction, boundary_coord, type):
-        self.slack = slack
-        self.direction = direction
-        self.boundary_coord = boundary_coord
-        self.type = type
-        if direction == '+':
-            if type == 'start':
-                self.lowerBound = boundary_coord - slack
-                self.upperBound = boundary_coord + (slack - 1)
-            elif type == 'end':
-                self.lowerBound = boundary_coord - (slack - 1)
-                self.upperBound = boundary_coord + slack
-            else:
-                exit('ExonBoundary: bad type (%s), not start or end' % type)
-        elif direction == '-':
-            if type == 'start':
-                self.lowerBound = boundary_coord - (slack - 1)
-                self.upperBound = boundary_coord + slack
-            elif type == 'end':
-                self.lowerBound = boundary_coord - slack
-                self.upperBound = boundary_coord + (slack - 1)
-            else:
-                exit('ExonBoundary: bad type (%s), not start or end' % type)
-        else:
-            exit('ExonBoundary: bad direction (%s), not + or -' % direction)
-
-class CodingExonBoundary(ExonBoundary):
-    def __init__(self, slack, direction, boundary_coord, type):
-        super(CodingExonBoundary, self).__init__(slack, direction, boundary_coord, type)
-        #self.annotation = 'Within +/- %d of coding exon %s boundary' % (slack, type)
-    def annotate(self, pos):
-        if pos >= self.lowerBound and pos <= self.upperBound:
-            return 'Within %d of coding exon %s boundary' % (pos - self.boundary_coord, self.type)
+def exonBoundaryBounds(slack, direction, boundary_coord, type):
+    if direction == '+':
+        if type == 'start':
+            return (boundary_coord - slack, boundary_coord + (slack - 1))
+        elif type == 'end':
+            return (boundary_coord - (slack - 1), boundary_coord + slack)
         else:
-            return None
-    def __str__(self):
-        return "CodingExonBoundary %d %d" % (self.upperBound, self.lowerBound)
-
-class NonCodingExonBoundary(ExonBoundary):
-    def __init__(self, slack, direction, boundary_coord, type):
-        super(NonCodingExonBoundary, self).__init__(slack, direction, boundary_coord, type)
-        # self.annotation = 'Within +/- %d of NON-coding exon %s boundary' % (slack, type)
-    def annotate(self, pos):
-        if pos >= self.lowerBound and pos <= self.upperBound:
-            return 'Within %d of NON-coding exon %s boundary' % (pos - self.boundary_coord, self.type)
+            exit('ExonBoundary: bad type (%s), not start or end' % type)
+    elif direction == '-':
+        if type == 'start':
+            return (boundary_coord - (slack - 1), boundary_coord + slack)
+        elif type == 'end':
+            return (boundary_coord - slack, boundary_coord + (slack - 1))
         else:
-            return None
-    def __str__(self):
-        return "NonCodingExonBoundary %d %d" % (self.upperBound, self.lowerBound)
-
-class PartialCodingExonBoundary(ExonBoundary):
-    def __init__(self, slack, direction, boundary_coord, type):
-        super(PartialCodingExonBoundary, self).__init__(slack, direction, boundary_coord, type)
-        #self.annotation = 'Within +/- %d of PARTIAL-coding exon %s boundary' % (slack, type)
-    def annotate(self, pos):
-        if pos >= self.lowerBound and pos <= self.upperBound:
-            return 'Within %d of PARTIAL-coding exon %s boundary' % (pos - self.boundary_coord, self.type)
-        else:
-            return None
-    def __str__(self):
-        return "NonCodingExonBoundary %d %d" % (self.upperBound, self.lowerBound)
+            exit('ExonBoundary: bad type (%s), not start or end' % type)
+    else:
+        exit('ExonBoundary: bad direction (%s), not + or -' % direction)
 
 def readRefGene(options):
     with open(options.refGene) as refs:
@@ -218,7 +362,8 @@ def readRefGene(options):
            if len(row) >= 11:
                chr = row[2]
                if chr not in refGene:
-                   refGene[chr] = []
+                   refGene[chr] = FeatureColumns()
+               features = refGene[chr]
                direction = row[3]
                transcriptStart = safeReadInt(row[4]) + 1
                transcriptEnd = safeReadInt(row[5])
@@ -234,8 +379,9 @@ def readRefGene(options):
 
                # check if this is a coding gene
                if codingRegionStart < (codingRegionEnd + 1):
-                   codingStart = CodingRegionStart(direction, options.startslack, codingRegionStart, codingRegionEnd)
-                   refGene[chr].append(codingStart)
+                   # the annotation is the distance from the start, on either strand
+                   features.append(CODING_REGION_START, codingRegionStart,
+                       codingRegionStartBounds(direction, options.startslack, codingRegionStart, codingRegionEnd))
                exonStarts = map(lambda x: safeReadInt(x) + 1, row[9].rstrip(',').split(',')) # add one to fix up zero-based start coordinate
                exonEnds = map(lambda x: safeReadInt(x), row[10].rstrip(',').split(','))
                # if the gene is on the reverse strand then we swap the start and end coordinates.
@@ -248,19 +394,87 @@ def readRefGene(options):
                    isStartCoding = isCoding(codingRegionStart, codingRegionEnd, start)
                    isEndCoding = isCoding(codingRegionStart, codingRegionEnd, end)
                    if isStartCoding and isEndCoding:
-                       refGene[chr].append(CodingExonBoundary(options.spliceslack, direction, start, 'start'))
-                       refGene[chr].append(CodingExonBoundary(options.spliceslack, direction, end, 'end'))
+                       startKind, endKind = CODING_EXON_START, CODING_EXON_END
                    elif not isStartCoding and not isEndCoding:
-                       refGene[chr].append(NonCodingExonBoundary(options.spliceslack, direction, start, 'start'))
-                       refGene[chr].append(NonCodingExonBoundary(options.spliceslack, direction, end, 'end'))
+                       startKind, endKind = NONCODING_EXON_START, NONCODING_EXON_END
                    elif isStartCoding and not isEndCoding:
-                       refGene[chr].append(CodingExonBoundary(options.spliceslack, direction, start, 'start'))
-                       refGene[chr].append(PartialCodingExonBoundary(options.spliceslack, direction, end, 'end'))
-                   elif not isStartCoding and isEndCoding:
-                       refGene[chr].append(PartialCodingExonBoundary(options.spliceslack, direction, start, 'start'))
-                       refGene[chr].append(CodingExonBoundary(options.spliceslack, direction, end, 'end'))
+                       startKind, endKind = CODING_EXON_START, PARTIAL_CODING_EXON_END
+                   else: # not isStartCoding and isEndCoding
+                       startKind, endKind = PARTIAL_CODING_EXON_START, CODING_EXON_END
+                   features.append(startKind, start, exonBoundaryBounds(options.spliceslack, direction, start, 'start'))
+                   features.append(endKind, end, exonBoundaryBounds(options.spliceslack, direction, end, 'end'))
+    return dict((chr, indexFeatures(features)) for chr, features in refGene.items())
+
+# The first line of a cache file. The format depends on the byte order and
+# size of the array items, so they are part of it too.
+cacheMagic = 'FAVR refGene cache 1 %s %d %d\n' % (sys.byteorder, array('i').itemsize, array('b').itemsize)
+
+def cacheFilename(options):
+    return options.refGene + '.favrcache'
+
+def cacheKey(options):
+    '''Identify the refGene file and the slack values that the index was compiled from.'''
+    stat = os.stat(options.refGene)
+    return '%s %r %d %d %d\n' % (os.path.abspath(options.refGene), stat.st_mtime, stat.st_size,
+                                  options.startslack, options.spliceslack)
+
+def loadRefGene(options):
+    '''Read the indexed refGene from the cache file if it is up to date, otherwise
+    read the refGene file and save its index in the cache for next time.'''
+    if not options.cache:
+        return readRefGene(options)
+    filename = cacheFilename(options)
+    key = cacheKey(options)
+    refGene = readRefGeneCache(filename, key)
+    if refGene == None:
+        refGene = readRefGene(options)
+        try:
+            writeRefGeneCache(filename, key, refGene)
+        except (IOError, OSError), err:
+            print('Warning: could not save refGene cache %s: %s' % (filename, err))
     return refGene
 
+def readRefGeneCache(filename, key):
+    '''Return the indexed refGene from the cache file, or None if the file does
+    not exist, it was compiled from a different refGene file or slack, or it
+    is truncated or corrupt.'''
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'rb') as cache:
+            if cache.readline() != cacheMagic or cache.readline() != key:
+                return None
+            refGene = {}
+            # iterating over the file would read ahead past the arrays, so
+            # read the header of each chromosome with readline instead
+            line = cache.readline()
+            while line:
+                chr, size = line.rstrip('\n').split('\t')
+                index = FeatureIndex(array('i'), array('b'), array('i'))
+                index.segmentStarts.fromfile(cache, int(size))
+                index.segmentKinds.fromfile(cache, int(size))
+                index.segmentAnchors.fromfile(cache, int(size))
+                refGene[chr] = index
+                line = cache.readline()
+    except (EOFError, ValueError, IOError):
+        # the cache is rebuilt from the refGene file
+        return None
+    return refGene
+
+def writeRefGeneCache(filename, key, refGene):
+    # write to a temporary file first, so that a concurrent run never
+    # reads a partly written cache
+    tempFilename = '%s.%d' % (filename, os.getpid())
+    with open(tempFilename, 'wb') as cache:
+        cache.write(cacheMagic)
+        cache.write(key)
+        for chr, index in refGene.items():
+            cache.write('%s\t%d\n' % (chr, len(index.segmentStarts)))
+            index.segmentStarts.tofile(cache)
+            index.segmentKinds.tofile(cache)
+            index.segmentAnchors.tofile(cache)
+    os.rename(tempFilename, filename)
+
 def isCoding(codingStart, codingEnd, coord):
     return coord >= codingStart and coord <= codingEnd
 
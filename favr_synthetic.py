@@ -0,0 +1,165 @@
+'''
+Synthetic inputs for benchmarking the FAVR programs.
+
+Makes a random reference genome, SOLiD-like paired end BAM files (a 50 base
+read and a 35 base read in each pair) aligned to it, SIFT style variant
+lists and a refGene table of genes on it. Everything is made with the
+random module, so the same seed gives the same inputs.
+
+Some of the variants are carried by each BAM file: a share of the reads
+covering a carried variant have the variant base. A share of the carried
+variants are only on the 35 base reads, like the artefacts binned by
+favr_pe_bias_detector.py. Some bases have a quality too low for the pileup.
+'''
+
+import random
+import pysam
+
+# the lengths of the reads in a pair, and the distance from the start of the
+# first read to the end of the second read
+longReadLength = 50
+shortReadLength = 35
+insertSize = 150
+# the chance of a sequencing error at each base, and of a read having a deletion
+errorRate = 0.01
+deletionRate = 0.05
+# the chance of a base having a low quality, below the least base quality of
+# the pileup, and the high and low qualities (40 and 10) as FASTQ characters
+lowQualityRate = 0.1
+highQuality = 'I'
+lowQuality = '+'
+# the share of the reads covering a carried variant which have the variant base
+carrierReadShare = 0.5
+# the share of the carried variants which are only on the short reads
+shortOnlyShare = 0.1
+
+def syntheticReference(chromosomeCount, chromosomeLength):
+    '''A list of (name, sequence) of random chromosomes: chr1, chr2, ...'''
+    return [('chr%d' % (n + 1), ''.join(random.choice('ACGT') for base in xrange(chromosomeLength)))
+            for n in xrange(chromosomeCount)]
+
+def writeReference(filename, reference, lineWidth=60):
+    '''Write the reference as a FASTA file, with a FASTA index (.fai) next to it.'''
+    with open(filename, 'w') as fasta:
+        with open(filename + '.fai', 'w') as fai:
+            for name, sequence in reference:
+                fasta.write('>%s\n' % name)
+                fai.write('%s\t%d\t%d\t%d\t%d\n' % (name, len(sequence), fasta.tell(), lineWidth, lineWidth + 1))
+                for start in xrange(0, len(sequence), lineWidth):
+                    fasta.write(sequence[start:start + lineWidth] + '\n')
+
+def syntheticVariants(reference, count):
+    '''A list of (chromosome, position, reference base, variant base), sorted by
+    coordinate, at random positions (1-based) away from the chromosome ends.'''
+    variants = []
+    for n in xrange(count):
+        name, sequence = random.choice(reference)
+        position = random.randint(insertSize, len(sequence) - insertSize)
+        refBase = sequence[position - 1]
+        variantBase = random.choice([base for base in 'ACGT' if base != refBase])
+        variants.append((name, position, refBase, variantBase))
+    names = [chr for chr, chrSequence in reference]
+    variants.sort(key=lambda (name, position, refBase, variantBase): (names.index(name), position))
+    return variants
+
+def variantRow(variant, n):
+    '''The columns of a SIFT style row for a variant: the coordinates, a gene and some information.'''
+    name, position, refBase, variantBase = variant
+    return ['%s,%d,1,%s/%s' % (name[3:], position, refBase, variantBase), 'gene%d' % n, 'info %d' % n]
+
+def writeVariantRows(filename, variants, delimiter='\t'):
+    '''Write a variant list: tab separated for favr_rare_and_true_filter.py and
+    the other programs, or comma separated for favr_pe_bias_detector.py.'''
+    with open(filename, 'w') as output:
+        for n, variant in enumerate(variants):
+            output.write(delimiter.join(variantRow(variant, n)) + '\n')
+
+def writeSyntheticBam(filename, reference, pairs, variants, carrierRate):
+    '''Write a sorted and indexed BAM file of read pairs at random positions on
+    the reference, carrying each variant with the chance carrierRate.'''
+    carried = {}
+    for name, position, refBase, variantBase in variants:
+        if random.random() < carrierRate:
+            carried[(name, position - 1)] = (variantBase, random.random() < shortOnlyShare)
+    header = { 'HD': {'VN': '1.0', 'SO': 'coordinate'},
+               'SQ': [{'SN': name, 'LN': len(sequence)} for name, sequence in reference] }
+    reads = []
+    for n in xrange(pairs):
+        referenceId = random.randrange(len(reference))
+        name, sequence = reference[referenceId]
+        start = random.randrange(0, len(sequence) - insertSize)
+        mateStart = start + insertSize - shortReadLength
+        first = syntheticRead('pair%d' % n, sequence, name, carried, referenceId, start, longReadLength,
+                              0x1 | 0x2 | 0x20 | 0x40)
+        second = syntheticRead('pair%d' % n, sequence, name, carried, referenceId, mateStart, shortReadLength,
+                               0x1 | 0x2 | 0x10 | 0x80)
+        first.mpos, second.mpos = mateStart, start
+        first.mrnm = second.mrnm = referenceId
+        first.isize, second.isize = insertSize, -insertSize
+        reads.extend([first, second])
+    reads.sort(key=lambda read: (read.rname, read.pos))
+    with pysam.Samfile(filename, 'wb', header = header) as bam:
+        for read in reads:
+            bam.write(read)
+    pysam.index(filename)
+
+def syntheticRead(qname, sequence, name, carried, referenceId, start, length, flag):
+    '''A read of the reference from start, with sequencing errors, sometimes a
+    deletion, and the base of any carried variants it covers.'''
+    cigar = [(0, length)]
+    deletionLength = 0
+    if random.random() < deletionRate:
+        deletionLength = 2
+        split = random.randint(5, length - 5)
+        cigar = [(0, split), (2, deletionLength), (0, length - split)]
+    bases = []
+    refPos = start
+    for op, opLength in cigar:
+        if op == 0:
+            for offset in xrange(opLength):
+                base = sequence[refPos]
+                variant = carried.get((name, refPos))
+                if variant and random.random() < carrierReadShare and \
+                        (length == shortReadLength or not variant[1]):
+                    base = variant[0]
+                elif random.random() < errorRate:
+                    base = random.choice('ACGT')
+                bases.append(base)
+                refPos += 1
+        else:
+            refPos += opLength
+    read = pysam.AlignedRead()
+    read.qname = qname
+    read.flag = flag
+    read.rname = referenceId
+    read.pos = start
+    read.mapq = 60
+    read.seq = ''.join(bases)
+    # some low base qualities, so that the evidence engines must leave the
+    # same bases out of the counts to agree
+    read.qual = ''.join(lowQuality if random.random() < lowQualityRate else highQuality
+                        for base in xrange(length))
+    read.cigar = cigar
+    return read
+
+def writeSyntheticRefGene(filename, reference, genes):
+    '''Write a refGene table of genes at random positions on the reference,
+    each with one to five exons, some of them non-coding.'''
+    with open(filename, 'w') as output:
+        for n in xrange(genes):
+            name, sequence = random.choice(reference)
+            txStart = random.randrange(0, len(sequence) - 3000)
+            exonCount = random.randint(1, 5)
+            bounds = sorted(random.sample(xrange(txStart + 1, txStart + 3000), exonCount * 2))
+            exonStarts = bounds[0::2]
+            exonEnds = bounds[1::2]
+            txEnd = exonEnds[-1]
+            if random.random() < 0.2:
+                # non-coding
+                cdsStart = cdsEnd = txEnd
+            else:
+                cdsStart = random.randrange(txStart, txEnd)
+                cdsEnd = random.randrange(cdsStart, txEnd + 1)
+            output.write('\t'.join(map(str, [n, 'NM_%d' % n, name, random.choice('+-'), txStart, txEnd,
+                cdsStart, cdsEnd, exonCount, ','.join(map(str, exonStarts)) + ',',
+                ','.join(map(str, exonEnds)) + ',', 0, 'GENE%d' % n])) + '\n')
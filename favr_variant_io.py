@@ -0,0 +1,220 @@
+'''
+Read and write variant lists, plain or bgzip compressed.
+
+A variant list is a SIFT style TSV file (or CSV file, for
+favr_pe_bias_detector.py), or a VCF file. Any of them may be compressed
+with bgzip, which is what a name ending in .gz means. VCF files are read
+with pysam, and each single base variant of a VCF record is turned into a
+SIFT style row: the coordinates, followed by the columns of the record.
+A VCF file with a tabix index (.tbi or .csi) is only read in the region
+of a run.
+
+Outputs whose names end in .gz are written bgzip compressed. Tabix can
+not index SIFT style rows, whose coordinates are in one comma separated
+column, so the variant rows of a compressed output are indexed in a file
+of their own, with .fvi added to the name. Each line of the index is a
+block of rows of one chromosome in the compressed file:
+
+    chromosome  first position  last position  virtual offset  number of rows
+
+where the virtual offset is that of a BGZF file, as in a BAM index. Rows
+which are not variants (such as a title row) are in blocks of their own,
+with the chromosome "*", which are always read. A compressed variant list
+with an index is only read in the region of a run. Uncompressed variant
+lists can be compressed and indexed with favr_compress_variants.py.
+'''
+
+import os
+import sys
+import csv
+import gzip
+import pysam
+from contextlib import (contextmanager, closing)
+from favr_common import parseVariantRow
+
+# the most rows in a block of the index of a compressed variant list
+indexBlockRows = 256
+# the chromosome of the index blocks of rows which are not variants
+nonVariantChromosome = '*'
+
+def isCompressed(filename):
+    return filename.endswith('.gz')
+
+def isVcf(filename):
+    return filename.endswith('.vcf') or filename.endswith('.vcf.gz')
+
+def variantIndexFilename(filename):
+    return filename + '.fvi'
+
+def checkPysam(name, purpose):
+    '''Older versions of pysam can not read VCF files or bgzip compressed files.'''
+    if not hasattr(pysam, name):
+        raise Exception, '%s needs a newer version of pysam, with %s' % (purpose, name)
+
+def openText(filename):
+    '''Open a text file for reading, which may be gzip (or bgzip) compressed.'''
+    if isCompressed(filename):
+        # a GzipFile can only be used in a with statement from Python 2.7
+        return closing(gzip.open(filename, 'rb'))
+    return open(filename)
+
+def readVariantRows(filename, delimiter='\t', region=None):
+    '''Yield the rows of a variant list, in order. With a region (chromosome,
+    start, end) and an index, only the blocks of rows which may be in the
+    region are read, so some rows outside of it may still be given.'''
+    if isVcf(filename):
+        rows = readVcfRows(filename, delimiter, region)
+    elif region != None and isCompressed(filename) and os.path.exists(variantIndexFilename(filename)):
+        rows = readIndexedRows(filename, delimiter, region)
+    else:
+        rows = readTextRows(filename, delimiter)
+    for row in rows:
+        yield row
+
+def readTextRows(filename, delimiter):
+    with openText(filename) as variants:
+        for row in csv.reader(variants, delimiter=delimiter, quotechar='|'):
+            yield row
+
+def readIndexedRows(filename, delimiter, region):
+    checkPysam('BGZFile', 'reading part of a compressed variant list')
+    chr, start, end = region
+    blocks = [block for block in readVariantIndex(variantIndexFilename(filename))
+              if block.chromosome == nonVariantChromosome or
+                 (block.chromosome == chr and block.first <= end and block.last >= start)]
+    variants = pysam.BGZFile(filename, 'rb')
+    try:
+        for block in blocks:
+            variants.seek(block.offset)
+            lines = [variants.readline() for n in xrange(block.rows)]
+            for row in csv.reader(lines, delimiter=delimiter, quotechar='|'):
+                yield row
+    finally:
+        variants.close()
+
+def readVcfRows(filename, delimiter, region):
+    '''The SIFT style rows of the single base variants of a VCF file.'''
+    checkPysam('VariantFile', 'reading VCF files')
+    vcf = pysam.VariantFile(filename)
+    try:
+        if region != None and vcf.index != None:
+            chr, start, end = region
+            # VCF files may leave the "chr" prefix off the chromosome names
+            contig = chr if chr in vcf.header.contigs else chr[3:]
+            if contig not in vcf.header.contigs:
+                records = []
+            elif end == sys.maxint:
+                # a whole chromosome region, whose end is beyond what the index allows
+                records = vcf.fetch(contig, start - 1)
+            else:
+                records = vcf.fetch(contig, start - 1, end)
+        else:
+            records = vcf
+        for record in records:
+            for row in vcfRows(record, delimiter):
+                yield row
+    finally:
+        vcf.close()
+
+def vcfRows(record, delimiter='\t'):
+    '''A SIFT style row for each single base variant of a VCF record: the
+    "chromosome,position,1,ref/variant" coordinates (split into columns
+    if the delimiter is a comma) followed by the columns of the record.'''
+    columns = str(record).rstrip('\n').split('\t')
+    chr = record.chrom[3:] if record.chrom.startswith('chr') else record.chrom
+    rows = []
+    for alt in record.alts or []:
+        if len(record.ref) == 1 and len(alt) == 1:
+            coordinates = [chr, str(record.pos), '1', '%s/%s' % (record.ref.upper(), alt.upper())]
+            if delimiter == ',':
+                rows.append(coordinates + columns)
+            else:
+                rows.append([','.join(coordinates)] + columns)
+    return rows
+
+def rowInfo(row, delimiter):
+    '''The VariantInfo of a variant row, or None if it is not a variant.'''
+    if delimiter == ',':
+        # the coordinates are split into columns
+        row = [','.join(row[:4])]
+    return parseVariantRow(row)
+
+@contextmanager
+def openOutput(filename, mode='w', delimiter=None):
+    '''Open an output file, bgzip compressed if its name ends in .gz. The
+    rows of a compressed output are indexed if it is a variant list, with
+    rows split by the delimiter, which must each be written in one call.'''
+    if not isCompressed(filename):
+        with open(filename, mode) as output:
+            yield output
+        return
+    output = CompressedOutput(filename) if delimiter == None else IndexedOutput(filename, delimiter)
+    try:
+        yield output
+    finally:
+        output.close()
+
+class CompressedOutput(object):
+    '''A bgzip compressed output file.'''
+    def __init__(self, filename):
+        checkPysam('BGZFile', 'writing compressed files')
+        self.filename = filename
+        self.file = pysam.BGZFile(filename, 'wb')
+    def write(self, data):
+        self.file.write(data)
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+    def close(self):
+        self.file.close()
+
+class IndexedOutput(CompressedOutput):
+    '''A bgzip compressed variant list, indexed as it is written.'''
+    def __init__(self, filename, delimiter):
+        super(IndexedOutput, self).__init__(filename)
+        self.delimiter = delimiter
+        self.blocks = []
+    def write(self, line):
+        '''Write a whole row, ending with a newline.'''
+        for row in csv.reader([line], delimiter=self.delimiter, quotechar='|'):
+            info = rowInfo(row, self.delimiter)
+            if info:
+                self.addRow(info.chromosome, info.position)
+            else:
+                self.addRow(nonVariantChromosome, 0)
+        self.file.write(line)
+    def addRow(self, chr, position):
+        block = self.blocks[-1] if self.blocks else None
+        if block == None or block.chromosome != chr or block.rows >= indexBlockRows:
+            self.blocks.append(IndexBlock(chr, position, position, self.file.tell(), 1))
+        else:
+            block.first = min(block.first, position)
+            block.last = max(block.last, position)
+            block.rows += 1
+    def close(self):
+        self.file.close()
+        writeVariantIndex(variantIndexFilename(self.filename), self.blocks)
+
+class IndexBlock(object):
+    '''A block of rows of one chromosome in a compressed variant list.'''
+    def __init__(self, chromosome, first, last, offset, rows):
+        self.chromosome = chromosome
+        self.first = first    # the least position of a row in the block
+        self.last = last      # the greatest position of a row in the block
+        self.offset = offset  # the virtual offset of the first row of the block
+        self.rows = rows      # the number of rows in the block
+
+def writeVariantIndex(filename, blocks):
+    with open(filename, 'w') as index:
+        for block in blocks:
+            index.write('%s\t%d\t%d\t%d\t%d\n' % (block.chromosome, block.first, block.last, block.offset, block.rows))
+
+def readVariantIndex(filename):
+    blocks = []
+    with open(filename) as index:
+        for line in index:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 5:
+                raise Exception, 'bad variant index line in %s: %s' % (filename, line.rstrip('\n'))
+            blocks.append(IndexBlock(fields[0], *map(int, fields[1:])))
+    return blocks
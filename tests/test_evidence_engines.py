@@ -0,0 +1,128 @@
+'''
+Check that the evidence engines give the same tallies on a BAM file with
+bases of mixed quality, deletions and reads which are left out of the
+pileup. Run from the top of the tree with:
+
+    python -m unittest discover tests
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import pysam
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from favr_common import (VariantTable, pileupTallies, sweepTallies, fetchTallies, columnTallies,
+                         PileupFilters, columnEngineAvailable,
+                         tallyBaseIndex, tallyDeletions, tallyCoverage)
+
+chromosomeLength = 200
+# the (1-based) site of the test, and the offset of the site in each read
+sitePosition = 100
+siteOffset = 10
+readLength = 40
+# a read which is longer than the others ends at this position
+longReadLength = readLength + 10
+lowOnlyPosition = sitePosition - siteOffset + longReadLength - 1
+highQuality = 'I'   # 40
+lowQuality = '+'    # 10, below the least quality of the pileup
+
+def makeRead(name, sequence, qualities, cigar=None, flag=0):
+    read = pysam.AlignedRead()
+    read.qname = name
+    read.flag = flag
+    read.rname = 0
+    read.pos = sitePosition - 1 - siteOffset
+    read.mapq = 60
+    read.seq = sequence
+    read.qual = qualities
+    read.cigar = cigar or [(0, len(sequence))]
+    return read
+
+def withBase(base, quality):
+    '''A read with the base of the given quality at the site.'''
+    sequence = 'A' * siteOffset + base + 'A' * (readLength - siteOffset - 1)
+    qualities = highQuality * siteOffset + quality + highQuality * (readLength - siteOffset - 1)
+    return sequence, qualities
+
+def withDeletion(nextQuality):
+    '''A read with a two base deletion at the site, whose next base has the
+    given quality (which the pileup filters the deletion by).'''
+    sequence = 'A' * readLength
+    qualities = highQuality * siteOffset + nextQuality + highQuality * (readLength - siteOffset - 1)
+    return sequence, qualities, [(0, siteOffset), (2, 2), (0, readLength - siteOffset)]
+
+class TestEvidenceEngines(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bamFile = os.path.join(self.directory, 'mixed.bam')
+        reads = []
+        for n,(base,quality) in enumerate([('C', highQuality), ('C', highQuality), ('C', lowQuality),
+                                           ('C', lowQuality), ('G', highQuality), ('G', lowQuality)]):
+            sequence, qualities = withBase(base, quality)
+            reads.append(makeRead('base%d' % n, sequence, qualities))
+        for n,quality in enumerate([highQuality, lowQuality]):
+            sequence, qualities, cigar = withDeletion(quality)
+            reads.append(makeRead('deletion%d' % n, sequence, qualities, cigar))
+        # a read which is the only one at its last position, with a low quality base there
+        sequence = 'A' * longReadLength
+        qualities = highQuality * (longReadLength - 1) + lowQuality
+        reads.append(makeRead('lowOnly', sequence, qualities))
+        # a read without qualities, whose base is only counted without a
+        # least base quality
+        sequence, qualities = withBase('T', highQuality)
+        reads.append(makeRead('noQualities', sequence, None))
+        # a duplicate read, left out altogether
+        sequence, qualities = withBase('C', highQuality)
+        reads.append(makeRead('duplicate', sequence, qualities, flag=0x400))
+        header = { 'HD': {'VN': '1.0', 'SO': 'coordinate'},
+                   'SQ': [{'SN': 'chr1', 'LN': chromosomeLength}] }
+        with pysam.Samfile(self.bamFile, 'wb', header = header) as bam:
+            for read in reads:
+                bam.write(read)
+        pysam.index(self.bamFile)
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    def tallies(self, engine):
+        sites, siteIndices = VariantTable([['1,%d,1,A/C' % sitePosition], ['1,%d,1,A/G' % (sitePosition + 20)],
+                                           ['1,%d,1,A/G' % lowOnlyPosition]]).sites()
+        with pysam.Samfile(self.bamFile, 'rb') as bam:
+            return [list(tally) for tally in engine(sites, bam)]
+    def testPileup(self):
+        site, other, lowOnly = self.tallies(pileupTallies)
+        # every read but the duplicate covers the site, but only the high
+        # quality bases, and the deletion before a high quality base, are
+        # counted; the base of the read without qualities is left out
+        self.assertEqual(site[tallyCoverage], 10)
+        self.assertEqual(site[tallyBaseIndex['C']], 2)
+        self.assertEqual(site[tallyBaseIndex['G']], 1)
+        self.assertEqual(site[tallyBaseIndex['T']], 0)
+        self.assertEqual(site[tallyDeletions], 1)
+        self.assertEqual(other[tallyCoverage], 10)
+        self.assertEqual(other[tallyBaseIndex['A']], 9)
+        # a column whose only base is left out still has the coverage of its read
+        self.assertEqual(lowOnly, [0, 0, 0, 0, 0, 1])
+    def testSweep(self):
+        self.assertEqual(self.tallies(sweepTallies), self.tallies(pileupTallies))
+    def testFetch(self):
+        self.assertEqual(self.tallies(fetchTallies), self.tallies(pileupTallies))
+    @unittest.skipUnless(columnEngineAvailable(), 'the column engine needs pysam 0.10 or later')
+    def testColumn(self):
+        self.assertEqual(self.tallies(columnTallies), self.tallies(pileupTallies))
+    @unittest.skipUnless(columnEngineAvailable(), 'the column engine needs pysam 0.10 or later')
+    def testColumnMinBaseQual(self):
+        # without a least base quality, the base of every read is counted
+        filters = PileupFilters()
+        filters.minBaseQual = 0
+        site, other, lowOnly = self.tallies(lambda sites, bam: columnTallies(sites, bam, filters))
+        self.assertEqual(site[tallyCoverage], 10)
+        self.assertEqual(site[tallyBaseIndex['C']], 4)
+        self.assertEqual(site[tallyBaseIndex['G']], 2)
+        self.assertEqual(site[tallyBaseIndex['T']], 1)
+        self.assertEqual(site[tallyDeletions], 2)
+
+if __name__ == '__main__':
+    unittest.main()